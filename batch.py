@@ -0,0 +1,142 @@
+#!/usr/bin/python
+""" render text profiles for a list of heroes without going through reddit
+
+        batch.py heroes.txt profiles.md
+        batch.py heroes.txt profiles.json --json --workers 8
+        batch.py heroes.txt careers.md --career
+
+    heroes.txt has one hero per line as region,profile[,hero id or name];
+    with --career the hero is ignored and every hero on the profile is
+    summarised instead.
+    profiles are written as they finish (so not in input order); markdown
+    output gets a heading per hero, json output is one object per line.
+    lines that fail are reported on stderr and, for json, in the output """
+import sys
+import json
+import argparse
+import functools
+import traceback
+from multiprocessing.pool import ThreadPool
+import utils
+import logger
+import lookup
+import profiler
+import formatter
+import metadata
+import records
+
+config = utils.get_config_params('batch')
+
+def run(heroes, out, as_json=False, workers=None, career=False):
+    """ given a list of heroes (see utils.read_hero_list) and an open output
+        file, render every hero (or with career, every hero's whole profile)
+        with workers threads, writing each profile as it completes; returns
+        the number of heroes that failed """
+
+    if workers is None:
+        workers = config.get_int('workers')
+    metadata.load()
+
+    failed = 0
+    render = functools.partial(_render, career=career)
+    pool = ThreadPool(max(workers, 1))
+    try:
+        for hero, result, error in pool.imap_unordered(render, heroes):
+            if error:
+                failed += 1
+                sys.stderr.write('line {l}: {e}\n'.format(l=hero['line'],
+                                                          e=error))
+                logger.warn('Batch failed line {l} ({r} {p}): {e}',
+                            l=hero['line'], r=hero['region'],
+                            p=hero['profile'], e=error)
+            if as_json:
+                out.write(_format_json(hero, result, error))
+            elif not error:
+                out.write(_format_markdown(hero, result))
+            out.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return failed
+
+
+def _render(hero, career=False):
+    """ given a hero from the hero list, look it up and profile it (or its
+        whole career); returns a tuple of
+        (hero, { 'data': profile data, 'text': formatted text },
+         error message or None) """
+
+    if not hero['profile']:
+        return hero, None, 'no profile given'
+
+    try:
+        if career:
+            data = profiler.get_career(hero['profile'], region=hero['region'])
+            if not data:
+                return hero, None, 'unable to load profile'
+            result = { 'data': data, 'text': formatter.format_career(data) }
+            return hero, result, None
+
+        hero_data = lookup.hero_lookup(hero['profile'], hero=hero['hero'],
+                                       hero_id=hero['hero_id'],
+                                       region=hero['region'])
+        if not hero_data:
+            return hero, None, 'unable to load hero'
+
+        profile = profiler.get_profile(hero_data, region=hero['region'])
+        if not profile:
+            return hero, None, 'unable to load gear'
+
+        result = { 'data': profile,
+                   'text': formatter.format_profile(profile) }
+        return hero, result, None
+    except Exception, e:
+        logger.error('Batch error on line {l}:\n{tb}', l=hero['line'],
+                     tb=traceback.format_exc())
+        return hero, None, 'error: {e}'.format(e=e)
+
+def _format_markdown(hero, result):
+    """ given a hero and its render result, return its markdown entry """
+
+    heading = u'## {p} ({r}) - line {l}'.format(p=hero['profile'],
+                                                r=hero['region'],
+                                                l=hero['line'])
+    entry = u'{h}\n\n{t}\n\n'.format(h=heading, t=result['text'])
+    return entry.encode('utf-8')
+
+def _format_json(hero, result, error):
+    """ given a hero, its render result and any error, return its json
+        line """
+
+    entry = { 'line': hero['line'], 'region': hero['region'],
+              'profile': hero['profile'], 'hero_id': hero['hero_id'],
+              'hero': hero['hero'] }
+    if error:
+        entry['error'] = error
+    else:
+        entry.update(result)
+    return json.dumps(entry, sort_keys=True, default=records.to_json) + '\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render text profiles for a '
+                                     'list of heroes')
+    parser.add_argument('heroes', help='file of region,profile[,hero] lines')
+    parser.add_argument('output', help='file to write the profiles to')
+    parser.add_argument('--json', action='store_true',
+                        help='write json lines instead of markdown')
+    parser.add_argument('--workers', type=int,
+                        help='heroes to render at once (default from config)')
+    parser.add_argument('--career', action='store_true',
+                        help='summarise every hero on each profile')
+    args = parser.parse_args()
+
+    heroes = utils.read_hero_list(args.heroes)
+    with open(args.output, 'w') as out:
+        failed = run(heroes, out, as_json=args.json, workers=args.workers,
+                     career=args.career)
+
+    print '{n} profiles written, {f} failed'.format(n=len(heroes) - failed,
+                                                    f=failed)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+""" offline benchmark for the profiling pipeline
+
+    record real Battle.net responses for a list of heroes:
+        benchmark.py record heroes.txt fixtures/
+
+    then replay them through lookup, profiler and formatter with the network
+    stubbed out, reporting per-stage timings and allocations and the time
+    spent in each profiler and formatter function:
+        benchmark.py replay heroes.txt fixtures/ --rounds 20
+
+    heroes.txt has one hero per line as region,profile[,hero id or name] """
+import os
+import gc
+import time
+import hashlib
+import argparse
+import utils
+import cache
+import lookup
+import profiler
+import formatter
+import metrics
+
+# pipeline stages in the order they run for a reply (see bot._create_post)
+STAGES = ('hero_lookup', 'fetch_gear', 'get_profile', 'format_profile')
+
+# the functions within the stages, timed by metrics (see metrics.timed)
+FUNCTIONS = ('profiler.get_intro_info', 'profiler.get_gear',
+             'profiler.get_stats', 'profiler.get_stats_from_gear',
+             'profiler.get_skills', 'formatter.format_intro',
+             'formatter.format_gear', 'formatter.format_stats',
+             'formatter.format_skills', 'formatter.format_outro')
+
+def record(heroes, fixture_dir):
+    """ given a list of heroes (see utils.read_hero_list) and a directory,
+        look up and profile each hero against the live api, saving every
+        response to the directory """
+
+    if not os.path.isdir(fixture_dir):
+        os.makedirs(fixture_dir)
+
+    fetch = lookup._fetch
+    def recording_fetch(api_url):
+        raw = fetch(api_url)
+        with open(_get_fixture_path(fixture_dir, api_url), 'w') as f:
+            f.write(raw)
+        return raw
+    lookup._fetch = recording_fetch
+
+    failed = 0
+    for hero in heroes:
+        try:
+            _render(hero, {})
+            print 'recorded line {l}: {p}'.format(l=hero['line'],
+                                                  p=hero['profile'])
+        except Exception, e:
+            failed += 1
+            print 'failed line {l}: {e}'.format(l=hero['line'], e=e)
+    print '{n} heroes recorded, {f} failed'.format(n=len(heroes) - failed,
+                                                   f=failed)
+
+def replay(heroes, fixture_dir, rounds):
+    """ given a list of heroes, a directory of recorded responses and a number
+        of rounds, render every hero rounds times from the recordings and
+        print the timings """
+
+    def replay_fetch(api_url):
+        path = _get_fixture_path(fixture_dir, api_url)
+        if not os.path.exists(path):
+            raise KeyError('no fixture for {u}'.format(u=api_url))
+        with open(path) as f:
+            return f.read()
+    lookup._fetch = replay_fetch
+
+    # warm up (metadata load, imports) and drop heroes that can't replay
+    playable = []
+    for hero in heroes:
+        try:
+            _render(hero, {})
+            playable.append(hero)
+        except Exception, e:
+            print 'skipping line {l}: {e}'.format(l=hero['line'], e=e)
+    if not playable:
+        print 'nothing to replay'
+        return
+
+    # allocations: one pass with the collector off, counting the objects
+    #   each stage leaves behind
+    allocations = dict.fromkeys(STAGES, 0)
+    for hero in playable:
+        _render(hero, {}, allocations=allocations)
+
+    timings = dict((stage, []) for stage in STAGES)
+    before = metrics.get_timings()
+    start = time.time()
+    for i in range(rounds):
+        for hero in playable:
+            _render(hero, timings)
+    elapsed = time.time() - start
+    after = metrics.get_timings()
+
+    replies = rounds * len(playable)
+    print '{n} heroes x {r} rounds = {t} replies in {e:.3f}s'.format(
+                            n=len(playable), r=rounds, t=replies, e=elapsed)
+    print '{s:<22}{a:>12}{mn:>12}{mx:>12}{o:>12}'.format(
+                            s='stage', a='avg ms', mn='min ms', mx='max ms',
+                            o='objects')
+    for stage in STAGES:
+        samples = timings[stage]
+        print '{s:<22}{a:>12.3f}{mn:>12.3f}{mx:>12.3f}{o:>12.1f}'.format(
+                            s=stage,
+                            a=1000 * sum(samples) / len(samples),
+                            mn=1000 * min(samples),
+                            mx=1000 * max(samples),
+                            o=float(allocations[stage]) / len(playable))
+
+    # the functions within the stages, counted over the timed rounds only
+    print '{f:<34}{a:>12}{c:>12}'.format(f='function', a='avg ms', c='calls')
+    for name in FUNCTIONS:
+        if name not in after:
+            continue
+        empty = { 'count': 0, 'total': 0.0 }
+        count = after[name]['count'] - before.get(name, empty)['count']
+        total = after[name]['total'] - before.get(name, empty)['total']
+        if count:
+            print '{f:<34}{a:>12.3f}{c:>12}'.format(f=name,
+                                                    a=1000 * total / count,
+                                                    c=count)
+    print 'end to end: {r:.1f} replies/s'.format(r=replies / elapsed)
+
+
+def _render(hero, timings, allocations=None):
+    """ given a hero from the hero list, run it through the pipeline the way
+        bot._create_post does, adding each stage's time in seconds to
+        timings (or its new object count to allocations) """
+
+    region = hero['region']
+    results = {}
+    steps = (
+        ('hero_lookup', lambda: lookup.hero_lookup(hero['profile'],
+                                                   hero=hero['hero'],
+                                                   hero_id=hero['hero_id'],
+                                                   region=region)),
+        ('fetch_gear', lambda: profiler.fetch_gear([results['hero_lookup']],
+                                                   region=region)),
+        ('get_profile', lambda: profiler.get_profile(
+                                        results['hero_lookup'], region=region,
+                                        items=results['fetch_gear'][0],
+                                        base_items=results['fetch_gear'][1])),
+        ('format_profile', lambda: formatter.format_profile(
+                                        results['get_profile']))
+    )
+
+    for stage, step in steps:
+        if allocations is not None:
+            gc.collect()
+            gc.disable()
+            before = len(gc.get_objects())
+            results[stage] = step()
+            allocations[stage] += len(gc.get_objects()) - before
+            gc.enable()
+        else:
+            start = time.time()
+            results[stage] = step()
+            timings.setdefault(stage, []).append(time.time() - start)
+
+        if results[stage] is None:
+            raise ValueError('{s} failed'.format(s=stage))
+
+    return results['format_profile']
+
+def _get_fixture_path(fixture_dir, api_url):
+    """ given the fixture directory and an api url, return the fixture file
+        for it """
+    name = hashlib.sha1(api_url.encode('utf-8')).hexdigest()
+    return os.path.join(fixture_dir, '{n}.json'.format(n=name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the profiling '
+                                     'pipeline against recorded responses')
+    parser.add_argument('mode', choices=('record', 'replay'))
+    parser.add_argument('heroes', help='file of region,profile[,hero] lines')
+    parser.add_argument('fixtures', help='directory of recorded responses')
+    parser.add_argument('--rounds', type=int, default=10,
+                        help='times to render each hero when replaying')
+    args = parser.parse_args()
+
+    # always go to the (real or stubbed) network, and don't share results
+    #   between calls, so every round does the full work
+    cache.config['enabled'] = '0'
+    lookup.config['coalesce_window'] = '0'
+
+    heroes = utils.read_hero_list(args.heroes)
+    if args.mode == 'record':
+        record(heroes, args.fixtures)
+    else:
+        replay(heroes, args.fixtures, args.rounds)
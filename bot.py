@@ -1,27 +1,43 @@
 #!/usr/bin/python
+import os
 import time
+import zlib
 import praw
 import traceback
 import re
+import threading
+import Queue
+import collections
+import atexit
+import contextlib
+import sqlite3
 import logger
 import utils
 import lookup
 import profiler
 import formatter
-
+import metadata
+import cache
+import dedup
+import state
+import poller
+import metrics
+
+_CONFIG_FILE = 'd3profilebot.config'
 config = utils.get_config_params('reddit_bot')
 
-# get the login info
-with open(config['login_file']) as f:
-    for l in f:
-        setting = ''.join(l.split()).split(':')
-        config[setting[0]] = setting[1]
+# login info from login_file { 'username', 'password' }, read on first use
+_login = None
 
 # posts we've searched
-#      key: hour the post was posted (0 for 12:00 AM - 12:59, etc)
-#      value: list of post_id
-#   this structure lets us easily remove lists of posts that are too old
-_searched = {}
+#   post ids bucketed by the time the post was made (dedup_bucket_size
+#   seconds per bucket); buckets older than max_timeframe are dropped each
+#   pass since we never look at posts that old.  its settings only change on
+#   a restart: raising max_timeframe on a reload would let through posts
+#   whose buckets were already dropped
+_searched = dedup.DedupStore(config.get_int('max_timeframe'),
+                             bucket_size=config.get_int('dedup_bucket_size'),
+                             compact=config.get_bool('dedup_compact'))
 
 # submissions we've replied to
 #      key: submission_id
@@ -34,87 +50,457 @@ _replied_to = {}
 #       value: amount of attempts failed
 _failed_posts = {}
 
+# posts to search again on the next pass: ones that failed (fewer than
+#   fails_allowed times, see _failed_posts) or didn't fit in the render queue.
+#   the listings won't return them again once the cursor has passed them
+#       key: post_id
+#       value: post
+_retry = collections.OrderedDict()
+
 # our posts
 #     key: post_id
-#     value: { 's_id': submission id, 'timestamp': timestamp of our post }
+#     value: { 's_id': submission id, 'timestamp': timestamp of our post,
+#              'checked': timestamp of the last karma check (if any) }
 #   we have to check our own posts to remove them at -1 karma.  we'll loop
 #       through these and check karma.  remove from this struct after 48 hours
 _our_posts = {}
 
-# search terms
-#   list of terms we'll search posts for
-_search_terms = config['search_terms'].split(',')
+# karma check schedule
+#   list of (max post age, seconds between checks) from karma_tiers, youngest
+#   first; newer posts get checked more often.  built by _get_karma_tiers
+_karma_tiers = None
+
+# current reddit connection; replaced by run when it reconnects
+_reddit = None
+
+# failed reconnects in a row, and when to try the next one; every listing
+#   waits on a reconnect, so it backs off once for all of them rather than
+#   with each poller's own backoff
+_connect_errors = 0
+_next_connect = 0
+
+# profile matcher
+#   one regex built from the search_terms, search_regions and search_locales
+#   settings that finds every hero url in a post in a single pass
+_matcher = None
+
+# guards the dictionaries above; they're shared by the poller, the render
+#   workers and the poster
+_state_lock = threading.RLock()
+
+# posts waiting to be rendered
+#       filled by the poller (run), drained by the render workers.  each job
+#       is a dictionary of { 'seq', 'post', 'reply', 'hero_info',
+#       'submission_id', 'queued', 'attempt' } and gets 'text' and 'rendered'
+#       added by the worker.  'attempt' is shared by the jobs queued for a
+#       post in one pass, see _add_to_failed
+_render_queue = Queue.Queue(maxsize=config.get_int('queue_depth'))
+
+# rendered jobs waiting to be posted; the poster puts them back in seq order
+_post_queue = Queue.Queue()
+
+# sequence number of the next job we queue
+_next_seq = 0
+
+# rendered replies, most recently used last; backed by the disk cache
+#       key: reply key (see _get_reply_key)
+#       value: reply text
+#   capped at reply_cache_size entries, least recently used are dropped
+_rendered = collections.OrderedDict()
+_rendered_lock = threading.Lock()
+
+# latency for each stage of the pipeline
+#       key: stage (queue, render, post)
+#       value: { 'count', 'total', 'max' } in seconds
+_stage_latency = {}
+_latency_lock = threading.Lock()
+
+# settings reload (see _reload_if_changed)
+#   the config file's modification time when we last fully reloaded it, and
+#   when to next check it and the stat tables for changes
+_config_mtime = None
+_next_reload = 0
+
+# config sections that changed in a reload whose config step hasn't finished
+#   yet; what's built from them is rebuilt once it has
+_reload_pending = set()
+
+# version of the settings replies are rendered with (the formatter and
+#   profiler config and the stat tables); part of the reply key, so changing
+#   any of them means fresh replies.  worked out by _get_render_version
+_render_version = None
+
+# renders in progress, and whether the settings are being swapped; a swap
+#   waits for running renders and holds new ones back, so every reply is
+#   rendered with one version of the settings (see _rendering).  only the
+#   profile and format step counts as rendering; the api lookups before it
+#   don't read the settings, so a swap never waits on them
+_render_gate = threading.Condition()
+_renders = 0
+_swapping = False
 
 def run():
     """ main logic for the bot, just loop through new posts and reply if
         we find a valid post """
+    global _reddit, _config_mtime, _connect_errors, _next_connect
+
+    # the config was read at import; changes after this get reloaded
+    _config_mtime = os.path.getmtime(_CONFIG_FILE)
+
+    # load the stat tables and build the matcher once up front so the first
+    #   reply doesn't wait
+    metadata.load()
+    _get_matcher()
+
+    # pick up where we left off; checking our reddit history is optional
+    _load_state()
+    state.start()
+    metrics.start()
+
+    r = _reddit = _connect()
 
-    r = _connect()
-    subreddit = r.get_subreddit(config['subreddit'])
+    if config.get_bool('reconcile_on_startup'):
+        _get_our_posts(48*60*60, r)
+    _start_pipeline()
+    _start_karma_sweep()
 
-    _get_our_posts(48*60*60, r)
+    pollers = _create_pollers()
 
     while True:
 
+        # swap in any changes to the settings between passes; a bad setting
+        #   mustn't stop the bot, so keep going with what we have
         try:
-            # go through sumbissions first
-            submissions = subreddit.get_new(limit=50)
-            for post in submissions:
-                if _filter_check(post):
-                    _add_reply(post)
-
-            # go through comments next
-            comments = r.get_comments(subreddit, limit=200)
-            for post in comments:
-                if _filter_check(post):
-                    _add_reply(post)
-
-            # check our own posts for negative karma, remove the posts 48 hours+
-            _remove_if_necessary(r)
+            pollers = _reload_if_changed(pollers)
         except Exception, e:
-            logger.error('{e}\n{t}\nreconnect in 30 seconds'.format(e=str(e),
+            logger.error('Unable to reload settings: {e}\n{t}'.format(e=str(e),
                                                     t=traceback.format_exc()))
-            time.sleep(30)
-            r = _connect()
 
-        time.sleep(10)
+        # poll whichever listing is due next, holding off if we're close to
+        #   reddit's rate limit
+        p = min(pollers, key=lambda p: p.next_run)
+        next_run = p.next_run if r else max(p.next_run, _next_connect)
+        delay = max(next_run - time.time(),
+                    poller.ratelimit_delay(config.get_int('ratelimit_reserve')))
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            if not r:
+                r = _reddit = _connect()
+
+            _retry_posts()
+        except Exception, e:
+            _connect_errors += 1
+            backoff = poller.get_backoff(_connect_errors,
+                                         config.get_float('error_backoff'),
+                                         config.get_float('max_backoff'))
+            _next_connect = time.time() + backoff
+            logger.error('{e}\n{t}\nreconnect in {s} seconds'.format(e=str(e),
+                                                    t=traceback.format_exc(),
+                                                    s=backoff))
+            r = None
+            continue
+
+        try:
+            posts = p.poll(r)
+            matches = 0
+            for post in posts:
+                if _process_post(post):
+                    matches += 1
+            # every post is handled (or waiting in _retry), so move past them
+            p.commit(posts)
+            p.schedule(len(posts), matches)
+            _connect_errors = 0
+
+            # forget searched posts we'd now filter out as too old anyway
+            if _searched.expire():
+                cutoff = time.time() - _searched.max_age
+                state.expire_searched(cutoff)
+                state.expire_failed(cutoff)
+
+            state.flush_if_due()
+        except Exception, e:
+            backoff = p.failed()
+            logger.error('{e}\n{t}\n{n}: retry in {s} seconds, '
+                         'reconnecting'.format(e=str(e),
+                                               t=traceback.format_exc(),
+                                               n=p.name, s=backoff))
+            r = None
+
+
+def _create_pollers():
+    """ return the submission and comment pollers for each shard listed in
+        the shards setting, or for the whole subreddit setting if there are
+        no shards.  each shard's [shard_<name>] config section has its own
+        subreddit and can override any of the poller settings.  sharding is
+        off by default; the config's [shard_diablo] and [shard_classes]
+        sections are an example, unused until listed in shards """
+
+    shards = config.get_list('shards') or [None]
+
+    pollers = []
+    for shard in shards:
+        settings = config
+        if shard:
+            settings = config.merged(utils.get_config_params(
+                                        'shard_{s}'.format(s=shard)))
+        name = shard or settings['subreddit']
+
+        # go through sumbissions first, comments next
+        pollers.append(_create_poller('{n} submissions'.format(n=name),
+                                      poller.fetch_submissions,
+                                      settings.get_int('submission_limit'),
+                                      settings))
+        pollers.append(_create_poller('{n} comments'.format(n=name),
+                                      poller.fetch_comments,
+                                      settings.get_int('comment_limit'),
+                                      settings))
+    return pollers
+
+
+def _create_poller(name, fetch, limit, settings):
+    """ given a listing name, praw fetch function (see poller), page size and
+        the settings to use, return a poller for the settings' subreddit """
+    return poller.ListingPoller(name, fetch, settings['subreddit'], limit,
+                                settings.get_int('max_limit'),
+                                settings.get_int('resync_passes'),
+                                settings.get_float('min_interval'),
+                                settings.get_float('max_interval'),
+                                settings.get_float('target_items'),
+                                settings.get_float('error_backoff'),
+                                settings.get_float('max_backoff'))
+
+
+def _reload_if_changed(pollers):
+    """ called between poll passes; every reload_interval seconds, check if
+        the config file or the stat tables have changed and if so swap in the
+        new settings, rebuilding anything compiled from them.  given the
+        current pollers, returns the pollers to use from now on """
+    global _config_mtime, _next_reload, _matcher, _karma_tiers, _render_version
+
+    interval = config.get_float('reload_interval', 0)
+    if not interval or time.time() < _next_reload:
+        return pollers
+    _next_reload = time.time() + interval
+
+    try:
+        mtime = os.path.getmtime(_CONFIG_FILE)
+    except OSError, e:
+        logger.error('Unable to check the config file: {e}'.format(e=e))
+        mtime = _config_mtime
+    # read the tables first, so the swap only holds renders back for as long
+    #   as it takes to swap them in.  failing to read them doesn't stop the
+    #   config reload
+    try:
+        tables = metadata.read_tables()
+    except sqlite3.Error:
+        # metadata logged it; they're read again on the next reload
+        tables = None
+    if mtime == _config_mtime and tables is None:
+        return pollers
+
+    with _swapping_settings():
+        if mtime != _config_mtime:
+            try:
+                _reload_pending.update(utils.reload_config(_CONFIG_FILE))
+                if 'formatter' in _reload_pending:
+                    formatter.reload()
+                # only once it's all done, so a failed reload is tried again
+                _config_mtime = mtime
+            except Exception, e:
+                logger.error('Unable to reload the config file: '
+                             '{e}\n{t}'.format(e=str(e),
+                                               t=traceback.format_exc()))
+        tables_changed = tables is not None and metadata.load(tables)
+        if _reload_pending & set(['formatter', 'profiler']) or tables_changed:
+            _render_version = None
+
+    # rebuild from the changed sections only once the config step is done;
+    #   until then they stay pending
+    changed = set()
+    if mtime == _config_mtime:
+        changed = set(_reload_pending)
+        _reload_pending.clear()
+
+    if not changed and not tables_changed:
+        return pollers
+    logger.info('Reloading settings: {s}'.format(s=', '.join(
+                sorted(changed) + (['stat tables'] if tables_changed else []))))
+
+    if 'logging' in changed:
+        logger.reload_level()
+
+    if 'reddit_bot' in changed:
+        dedup_settings = (config.get_int('max_timeframe'),
+                          config.get_int('dedup_bucket_size'),
+                          config.get_bool('dedup_compact'))
+        if dedup_settings != (_searched.max_age, _searched.bucket_size,
+                              _searched.compact):
+            logger.warn('max_timeframe and dedup settings only change on a '
+                        'restart')
+
+        # build the new matcher before swapping it in, so a bad setting
+        #   leaves the old one working
+        try:
+            _matcher = _compile_matcher(config.get_list('search_terms'),
+                                        config.get_list('search_regions'),
+                                        config.get_list('search_locales'))
+        except re.error, e:
+            logger.error('Bad search settings, keeping the old matcher: '
+                         '{e}'.format(e=e))
+        _karma_tiers = None
+
+    if 'reddit_bot' in changed or \
+            any(section.startswith('shard_') for section in changed):
+        pollers = _update_pollers(pollers)
+    return pollers
+
+@contextlib.contextmanager
+def _swapping_settings():
+    """ context manager around swapping in new settings; waits for the
+        renders in progress to finish and holds new ones back until the
+        block is done """
+    global _swapping
+
+    with _render_gate:
+        _swapping = True
+        while _renders:
+            _render_gate.wait()
+    try:
+        yield
+    finally:
+        with _render_gate:
+            _swapping = False
+            _render_gate.notify_all()
+
+@contextlib.contextmanager
+def _rendering():
+    """ context manager around a render; waits while the settings are being
+        swapped """
+    global _renders
+
+    with _render_gate:
+        while _swapping:
+            _render_gate.wait()
+        _renders += 1
+    try:
+        yield
+    finally:
+        with _render_gate:
+            _renders -= 1
+            _render_gate.notify_all()
+
+def _update_pollers(pollers):
+    """ given the current pollers, return pollers for the reloaded settings.
+        pollers whose settings are unchanged are kept as they are; changed
+        ones still reading the same listing keep their cursor """
+
+    current = dict((p.name, p) for p in pollers)
+    updated = []
+    for p in _create_pollers():
+        old = current.get(p.name)
+        if old and _get_poller_settings(old) == _get_poller_settings(p):
+            p = old
+        elif old and (old.fetch, old.subreddit) == (p.fetch, p.subreddit):
+            p.cursor = old.cursor
+        updated.append(p)
+    return updated
+
+def _get_poller_settings(p):
+    """ given a poller, return the settings it was created with """
+    return (p.fetch, p.subreddit, p.limit, p.max_limit, p.resync_passes,
+            p.min_interval, p.max_interval, p.target_items, p.error_backoff,
+            p.max_backoff)
 
 
 def _connect():
     """ Connects to Reddit through PRAW; returns the connection """
+    login = _get_login()
     r = praw.Reddit(user_agent = config['user_agent'])
-    r.login(config['username'], config['password'])
+    # keep track of reddit's rate limit headers for the poll scheduler
+    if hasattr(r, 'http'):
+        r.http.hooks.setdefault('response', []).append(poller.record_ratelimit)
+    r.login(login['username'], login['password'])
     return r
 
+def _get_login():
+    """ return the login info from login_file, reading it the first time """
+    global _login
+
+    if _login is None:
+        login = {}
+        with open(config['login_file']) as f:
+            for l in f:
+                setting = ''.join(l.split()).split(':')
+                login[setting[0]] = setting[1]
+        _login = login
+    return _login
+
+
+def _process_post(post):
+    """ given a new post (or one being retried), search it and queue a reply
+        for any heroes in it; returns true if it matched.  a post that raises
+        is counted as failed and retried later """
+
+    try:
+        heroes = _filter_check(post)
+        if heroes:
+            _queue_reply(post, heroes)
+            return True
+    except Exception, e:
+        logger.error('{e}\n{t}'.format(e=str(e), t=traceback.format_exc()))
+        _add_to_failed(post)
+    return False
+
+def _retry_posts():
+    """ search the posts waiting in _retry again """
+
+    with _state_lock:
+        posts = _retry.values()
+        _retry.clear()
+    for post in posts:
+        logger.debug('retrying {p}', p=post.id)
+        _process_post(post)
+
+def _retry_later(post):
+    """ given a post, forget we searched it and add it to _retry """
+
+    _searched.discard(post.id, post.created_utc)
+    state.forget_searched(post.id)
+    with _state_lock:
+        _retry[post.id] = post
+
 
 def _filter_check(post):
-    """ filter posts before trying to search them for valid posts """
+    """ filter posts before trying to search them for valid posts; returns
+        the list of heroes found in the post (see _search) """
 
     if post.author:
         # don't check our posts
-        if post.author.name == config['username'] or post.id in _our_posts:
-            logger.debug('{p} is our own post, continue'.format(p=post.id))
+        if post.author.name == _get_login()['username'] or \
+                post.id in _our_posts:
+            logger.debug('{p} is our own post, continue', p=post.id)
             return False
         # don't check posts we've already checked
-        hour = _get_hour(post.created_utc)
-        if hour in _searched and post.id in _searched[hour]:
-            logger.debug('{p} has been checked, continue'.format(p=post.id))
+        if _searched.contains(post.id, post.created_utc):
+            logger.debug('{p} has been checked, continue', p=post.id)
             return False
-        # don't check posts older than our max_timeframe setting
-        if post.created_utc < time.time() - int(config['max_timeframe']):
-            logger.debug('{p} is too old to check, continue'.format(p=post.id))
+        # don't check posts older than our max_timeframe setting (as of
+        #   startup, see _searched)
+        if post.created_utc < time.time() - _searched.max_age:
+            logger.debug('{p} is too old to check, continue', p=post.id)
             return False
 
-        logger.debug('searching {p}'.format(p=post.id))
+        logger.debug('searching {p}', p=post.id)
         return _search(post)
 
 def _search(post):
-    """ search through the post for a matching search term """
+    """ search through the post for hero urls; returns a list of hero info
+        dictionaries (see _find_heroes), empty if nothing matched """
 
-    hour = _get_hour(post.created_utc)
-    if hour not in _searched:
-        _searched[hour] = []
-    _searched[hour].append(post.id)
+    _searched.add(post.id, post.created_utc)
+    state.save_searched(post.id, post.created_utc)
 
     if 'body' in dir(post):
         to_search = post.body
@@ -124,94 +510,257 @@ def _search(post):
         submission = post
     else:
         logger.warn('Unable to search post {p}'.format(p=post.id))
+        return []
+
+    heroes = _find_heroes(to_search)
+    if heroes:
+        logger.debug('{p} matched {n} heroes', p=post.id, n=len(heroes))
+    return heroes
+
+def _find_heroes(content):
+    """ given a post content, return a list of every distinct hero linked in
+        it, in order, as dictionaries of { 'profile', 'hero_id', 'region' } """
+
+    heroes = []
+    for match in _get_matcher().finditer(content):
+        hero_info = { 'profile': match.group('profile'),
+                      'hero_id': match.group('hero_id'),
+                      'region': match.group('region').lower() }
+        if hero_info not in heroes:
+            heroes.append(hero_info)
+    return heroes
+
+def _get_matcher():
+    """ return the compiled profile matcher, building it the first time """
+    global _matcher
+
+    if not _matcher:
+        _matcher = _compile_matcher(config.get_list('search_terms'),
+                                    config.get_list('search_regions'),
+                                    config.get_list('search_locales'))
+    return _matcher
+
+def _compile_matcher(terms, regions, locales):
+    """ given the search terms (host and path up to the battletag, with
+        {locale} marking the locale part), regions and locales, return one
+        compiled regex matching any of them followed by profile/hero/id.
+        the match has 'region', 'profile' and 'hero_id' groups """
+
+    # longest first so en-us isn't cut short by en
+    locales = sorted(locales, key=len, reverse=True)
+    locale = '(?:{l})'.format(l='|'.join(re.escape(l) for l in locales))
+    paths = [re.escape(t).replace(re.escape('{locale}'), locale) for t in terms]
+    region = '|'.join(re.escape(r) for r in regions)
+
+    pattern = r'(?P<region>{r})\.(?:{p})(?P<profile>[^/\s\]\)]+)' \
+              r'/hero/(?P<hero_id>\d+)'.format(r=region, p='|'.join(paths))
+    return re.compile(pattern, re.IGNORECASE | re.UNICODE)
+
+def _start_pipeline():
+    """ start the render workers and the poster; they live as long as the bot
+        and pull from _render_queue and _post_queue """
+
+    for i in range(config.get_int('render_workers')):
+        t = threading.Thread(target=_render_worker,
+                             name='render-{i}'.format(i=i))
+        t.daemon = True
+        t.start()
+
+    t = threading.Thread(target=_poster, name='poster')
+    t.daemon = True
+    t.start()
+
+
+def _queue_reply(post, heroes):
+    """ given a post that meets the search criteria and the heroes found in it,
+        queue a reply for each hero to be rendered and posted; returns true if
+        they were all queued """
+    global _next_seq
 
-    for s in _search_terms:
-        if s in to_search:
-            logger.debug('{p} matched {s}'.format(p=post.id, s=s))
-            return True
-    return False
-
-def _get_hour(timestamp):
-    """ given a timestamp, return the hour it was created """
-
-    return time.strftime('%H', time.gmtime(timestamp))
-
-def _add_reply(post):
-    """ given a post that meets the search criteria, reply to it with the 
-        text profile; returns true if successful """
     if 'add_comment' in dir(post):
         reply = post.add_comment
-        content = post.selftext
         submission = post
     elif 'reply' in dir(post):
         reply = post.reply
-        content = post.body
         submission = post.submission
     else:
         logger.warn('Unable to reply to post {p}'.format(p = post.id))
+        return False
 
-    # hero_info is a dictionary of { 'profile', 'hero' OR 'hero_id', 'region'}
-    hero_info = _get_hero_info(content)
+    attempt = { 'failed': False }
+    for hero_info in heroes:
+        job = { 'seq': _next_seq, 'post': post, 'reply': reply,
+                'hero_info': hero_info, 'submission_id': submission.id,
+                'queued': time.time(), 'attempt': attempt }
+        try:
+            _render_queue.put_nowait(job)
+        except Queue.Full:
+            # leave it for a later pass rather than holding up polling; any
+            #   heroes already queued are caught by the replied-to check
+            logger.warn('Render queue full, {p} will be retried'.format(
+                                                                p=post.id))
+            _retry_later(post)
+            return False
+        _next_seq += 1
+
+    return True
+
+
+def _render_worker():
+    """ render worker thread; takes queued posts, builds the reply text and
+        hands the job on to the poster (failed jobs too, so the poster can
+        keep the posting order) """
+
+    while True:
+        job = _render_queue.get()
+        start = time.time()
+        _record_latency('queue', start - job['queued'])
+
+        try:
+            job['text'] = _render_reply(job)
+        except Exception, e:
+            logger.error('{e}\n{t}'.format(e=str(e), t=traceback.format_exc()))
+            job['text'] = None
+            _add_to_failed(job['post'], job['attempt'])
+
+        job['rendered'] = time.time()
+        _record_latency('render', job['rendered'] - start)
+        _post_queue.put(job)
 
-    if not hero_info:
-        _add_to_failed(post)
-        return False
+
+def _render_reply(job):
+    """ given a queued job, return the reply text for it or None if there's
+        nothing to post """
+
+    # hero_info is a dictionary of { 'profile', 'hero_id', 'region' }
+    hero_info = job['hero_info']
 
     # make sure we haven't posted this profile in this discussion already
-    if submission.id in _replied_to:
-        if hero_info in _replied_to[submission.id]:
-            logger.info('Already added {p} - {h} in {s}'.format(
-                                                    p=hero_info['profile'],
-                                                    h=hero_info['hero_id'],
-                                                    s=submission.id))
-            return False
-    else:
-        _replied_to[submission.id] = []
+    if _already_replied(job['submission_id'], hero_info):
+        return None
 
     formatted_reply = _create_post(hero_info)
-    if not reply:
+    if not formatted_reply:
         logger.warn('Unable to create reply, add to failed')
-        _add_to_failed(post)
+        _add_to_failed(job['post'], job['attempt'])
+        return None
+
+    return formatted_reply
+
+
+def _poster():
+    """ poster thread; replies to rendered jobs in the order they were queued,
+        waiting at least post_interval seconds between replies """
+
+    # rendered jobs that finished ahead of an earlier job
+    #       key: seq
+    #       value: job
+    waiting = {}
+    seq = 0
+    last_post = 0
+
+    while True:
+        job = _post_queue.get()
+        waiting[job['seq']] = job
+
+        while seq in waiting:
+            job = waiting.pop(seq)
+            seq += 1
+            if not job['text']:
+                continue
+
+            delay = last_post + config.get_float('post_interval') - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                _add_reply(job)
+            except Exception, e:
+                logger.error('{e}\n{t}'.format(e=str(e),
+                                               t=traceback.format_exc()))
+                _add_to_failed(job['post'], job['attempt'])
+            last_post = time.time()
+            _record_latency('post', last_post - job['rendered'])
+
+
+def _add_reply(job):
+    """ given a rendered job, reply to its post with the text profile; returns
+        true if successful """
+
+    post = job['post']
+    hero_info = job['hero_info']
+    s_id = job['submission_id']
+
+    # a worker may have rendered the same profile for this discussion while
+    #   we were posting the last one
+    if _already_replied(s_id, hero_info):
         return False
 
-    _replied_to[submission.id].append(hero_info)
-    r = reply(formatted_reply)
-    _our_posts[r.id] = { 'timestamp': r.created_utc, 's_id': submission.id }
+    while True:
+        try:
+            with metrics.timer('reddit.reply'):
+                r = job['reply'](job['text'])
+            break
+        except praw.errors.RateLimitExceeded, e:
+            logger.warn('Rate limited, retrying in {s} seconds'.format(
+                                                            s=e.sleep_time))
+            time.sleep(e.sleep_time)
+
+    with _state_lock:
+        _replied_to.setdefault(s_id, []).append(hero_info)
+        _our_posts[r.id] = { 'timestamp': r.created_utc, 's_id': s_id }
+    state.save_replied(s_id, hero_info, r.created_utc)
+    state.save_our_post(r.id, s_id, r.created_utc)
+    # write it now; losing it to a crash would mean posting it again
+    state.flush()
     logger.info('Added {p} - {h} in {r} to {sid} - {pid}'.format(
                                         p = hero_info['profile'],
                                         h = hero_info['hero_id'],
                                         r = hero_info['region'],
-                                        sid=submission.id,
+                                        sid=s_id,
                                         pid=post.id ))
     return True
 
 
-def _get_hero_info(content):
-    """ given a post content, return a dictionary of:
-        { 'profile', 'hero' OR 'hero_id', 'region' }
-        (note that if hero_id is found, don't include hero and vice-versa) """
+def _already_replied(s_id, hero_info):
+    """ given a submission id and hero info, return true if we've already
+        posted this profile in the submission """
+
+    with _state_lock:
+        if hero_info in _replied_to.get(s_id, []):
+            logger.info('Already added {p} - {h} in {s}'.format(
+                                                    p=hero_info['profile'],
+                                                    h=hero_info['hero_id'],
+                                                    s=s_id))
+            return True
+    return False
+
 
-    region = None
-    if config['base_url'].format(region='us').replace('http://','') in content:
-        region = 'us'
-    elif config['base_url'].format(region='eu').replace('http://','') in content:
-        region = 'eu'
+def _record_latency(stage, seconds):
+    """ add a latency sample (in seconds) for the given pipeline stage """
 
-    if not region:
-        logger.warn('No valid URL in post content:\n{c}'.format(c=content))
-        return None
+    with _latency_lock:
+        stats = _stage_latency.setdefault(stage,
+                                          { 'count': 0, 'total': 0, 'max': 0 })
+        stats['count'] += 1
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+    metrics.observe('pipeline.{s}'.format(s=stage), seconds)
+    logger.debug('{s} took {t:.3f}s', s=stage, t=seconds)
 
-    base_url = config['base_url'.format(region=region)]
 
-    t = content.split(base_url)
-    if len(t) > 1:
-        temp = t[1]
-    else:
-        temp = t[0]
-    hero_id = re.split('\D+', temp.split('hero/')[1])[0]
-    profile = temp.split('profile/')[1].split('/hero/')[0]
+def get_stage_latency():
+    """ return a dictionary of { stage: { 'count', 'avg', 'max' } } for the
+        reply pipeline along with the current queue depths """
 
-    return { 'profile': profile, 'hero_id': hero_id, 'region': region }
+    with _latency_lock:
+        latency = dict((stage, { 'count': stats['count'],
+                                 'avg': stats['total'] / stats['count'],
+                                 'max': stats['max'] })
+                       for stage, stats in _stage_latency.iteritems())
+    latency['depth'] = { 'render': _render_queue.qsize(),
+                         'post': _post_queue.qsize() }
+    return latency
 
 
 def _create_post(hero_info):
@@ -230,80 +779,221 @@ def _create_post(hero_info):
                                                                 r=region ))
         return None
 
-    intro = profiler.get_intro_info(hero, region=region)
-    gear = profiler.get_gear(hero, region=region)
-    stats = profiler.get_stats(hero, region=region)
-    gear_stats = profiler.get_stats_from_gear(gear, region=region)
-    skills = profiler.get_skills(hero, region=region)
+    # an unchanged hero renders the same reply, so reuse it if we have it
+    with _rendering():
+        key = _get_reply_key(hero, region)
+    cached = _get_cached_reply(key, region)
+    if cached:
+        logger.info('Using cached reply for {p} - {h} in {r}'.format(
+                                                                p=profile,
+                                                                h=hero_id,
+                                                                r=region ))
+        metrics.incr('replies.cached')
+        return cached
+
+    metrics.incr('replies.rendered')
+    # fetch the gear outside the render, so a settings swap doesn't wait on
+    #   the api; the render itself only reads what's already fetched
+    items, base_items = profiler.fetch_gear([hero], region=region)
+    with _rendering():
+        key = _get_reply_key(hero, region)
+        profile_data = profiler.get_profile(hero, region=region, items=items,
+                                            base_items=base_items)
+        if profile_data:
+            post = formatter.format_profile(profile_data)
+    if not profile_data:
+        logger.warn('Failed to load gear for {p} - {h} in {r}'.format(
+                                                                p=profile,
+                                                                h=hero_id,
+                                                                r=region ))
+        return None
+
+    _cache_reply(key, region, post)
+    return post
+
+
+def _get_reply_key(hero, region):
+    """ given hero data and a region, return the key for its rendered reply;
+        the hero's last-updated timestamp is part of the key so any change to
+        the hero gets a fresh reply.  each region has its own accounts, so
+        the region is part of it too """
+
+    return u'reply/{r}/{p}/{h}/{u}/{v}'.format(r=region,
+                                               p=hero['profile'].lower(),
+                                               h=hero['id'],
+                                               u=hero['last-updated'],
+                                               v=_get_render_version())
+
+def _get_render_version():
+    """ return the version of the rendering settings, a checksum of the
+        formatter and profiler config and the stat tables """
+    global _render_version
+
+    if _render_version is None:
+        settings = (sorted(formatter.config.items()),
+                    sorted(profiler.config.items()),
+                    metadata.get_version())
+        _render_version = '{v:08x}'.format(
+                                v=zlib.crc32(repr(settings)) & 0xffffffff)
+    return _render_version
+
+def _get_cached_reply(key, region):
+    """ given a reply key and region, return the cached reply text from memory
+        or the disk cache, or None if we don't have it """
+
+    with _rendered_lock:
+        if key in _rendered:
+            # move it to the most recently used end
+            _rendered[key] = _rendered.pop(key)
+            return _rendered[key]
+
+    text = cache.get(region, key, 'reply')
+    if text:
+        _remember_reply(key, text)
+    return text
+
+def _cache_reply(key, region, text):
+    """ store a rendered reply in memory and the disk cache """
+    _remember_reply(key, text)
+    cache.put(region, key, 'reply', text)
+
+def _remember_reply(key, text):
+    """ add a reply to the in-memory cache, dropping the least recently used
+        replies past reply_cache_size """
+
+    with _rendered_lock:
+        _rendered.pop(key, None)
+        _rendered[key] = text
+        while len(_rendered) > config.get_int('reply_cache_size'):
+            _rendered.popitem(last=False)
+
+
+def _add_to_failed(post, attempt=None):
+    """ given a post, add it to the failed dictionary and, until it has
+        failed fails_allowed times, retry it on a later pass.  given the
+        attempt of a queued job, the post is only counted once for all the
+        jobs (one per hero) queued with it in that pass """
+
+    with _state_lock:
+        if attempt is not None:
+            if attempt['failed']:
+                return
+            attempt['failed'] = True
+
+        if post.id in _failed_posts:
+            _failed_posts[post.id] += 1
+        else:
+            _failed_posts[post.id] = 1
+        state.save_failed(post.id, _failed_posts[post.id], post.created_utc)
 
-    post = []
-    post.append(formatter.format_intro(intro))
-    post.append(formatter.format_gear(gear))
-    post.append(formatter.format_stats(stats, gear_stats=gear_stats))
-    post.append(formatter.format_skills(skills))
-    post.append(formatter.format_outro())
+        if _failed_posts[post.id] < config.get_int('fails_allowed'):
+            _retry_later(post)
+            logger.info('Failed to create post in {p}, try again'.format(
+                                                                p=post.id))
+        else:
+            logger.info('Giving up on creating post in {p}'.format(p=post.id))
 
-    return u''.join(post)
 
+def _start_karma_sweep():
+    """ start the karma sweep thread; it checks our posts on its own schedule,
+        independent of the poll loop """
 
-def _add_to_failed(post):
-    """ given a post, add it to the failed dictionary """
+    t = threading.Thread(target=_karma_sweeper, name='karma')
+    t.daemon = True
+    t.start()
 
-    if post.id in _failed_posts:
-        _failed_posts[post.id] += 1
-    else:
-        _failed_posts[post.id] = 1
 
-    if _failed_posts[post.id] < config['fails_allowed']:
-        hour = _get_hour(post.created_utc)
-        _searched[hour].remove(post.id)
-        logger.info('Failed to create post in {p}, try again'.format(p=post_id))
-    else:
-        logger.info('Giving up on creating post in {p}'.format(p=post_id))
+def _karma_sweeper():
+    """ karma sweep thread; runs _remove_if_necessary every karma_interval
+        seconds """
 
+    while True:
+        try:
+            _remove_if_necessary(_reddit)
+        except Exception, e:
+            logger.error('{e}\n{t}'.format(e=str(e), t=traceback.format_exc()))
+        time.sleep(config.get_float('karma_interval'))
 
-def _remove_if_necessary(r):
-    """ given a reddit connection, check our posts to see if they need 
-        to be removed.  if so, remove them.
-        also remove all posts from our dictionary older than 48 hours """
 
-    removal_time = time.time() - 48*60*60
+def _remove_if_necessary(r):
+    """ given a reddit connection, check our posts that are due a karma check
+        (see _karma_tiers) to see if they need to be removed.  if so, remove
+        them.  the checks are batched into info requests of up to 100 posts.
+        also remove all posts from our dictionary older than 48 hours, and
+        the saved replies from before then """
+
+    now = time.time()
+    removal_time = now - 48*60*60
     posts_to_delete = []
-    for post_id in _our_posts:
-        if _our_posts[post_id]['timestamp'] < removal_time:
-            posts_to_delete.append(post_id)
-            continue
+    due = []
+    with _state_lock:
+        for post_id, post in _our_posts.iteritems():
+            if post['timestamp'] < removal_time:
+                posts_to_delete.append(post_id)
+            elif now - post.get('checked', 0) >= \
+                    _get_karma_interval(now - post['timestamp']):
+                due.append(post_id)
 
-        s_url = 'http://www.reddit.com/r/{s}/comments/{sid}/_/{pid}'.format(
-                                s = config['subreddit'],
-                                sid=_our_posts[post_id]['s_id'],
-                                pid=post_id)
-        s = r.get_submission(s_url)
+    for i in range(0, len(due), 100):
+        batch = due[i:i+100]
+        found = r.get_info(thing_id=['t1_{p}'.format(p=p) for p in batch])
 
-        if not s or not s.comments:
-            logger.warn('Failed to find submission at {u}'.format(u=s_url))
-            posts_to_delete.append(post_id)
-        else:
-            post = s.comments[0]
+        for post in found:
+            with _state_lock:
+                if post.id in _our_posts:
+                    _our_posts[post.id]['checked'] = now
 
             if post.score < 0:
                 logger.info('Removing {s} - {p} due to score ({sc})'.format(
-                                                s=_our_posts[post_id]['s_id'],
-                                                p=post_id,
+                                                s=post.link_id,
+                                                p=post.id,
                                                 sc=post.score))
                 post.delete()
-                posts_to_delete.append(post_id)
+                posts_to_delete.append(post.id)
+
+        # anything reddit didn't return is gone already
+        missing = set(batch) - set(post.id for post in found)
+        for post_id in missing:
+            logger.warn('Failed to find our post {p}'.format(p=post_id))
+        posts_to_delete.extend(missing)
+
+    with _state_lock:
+        for p in posts_to_delete:
+            if p in _our_posts:
+                del _our_posts[p]
+                state.forget_our_post(p)
+    # we stop tracking our posts after 48 hours, so forget the heroes we
+    #   replied with by then too
+    state.expire_replied(removal_time)
+
+
+def _get_karma_interval(age):
+    """ given the age of one of our posts in seconds, return how often (in
+        seconds) its karma should be checked """
+
+    tiers = _get_karma_tiers()
+    for max_age, interval in tiers:
+        if age < max_age:
+            return interval
+    return tiers[-1][1]
+
+def _get_karma_tiers():
+    """ return the karma check schedule, building it the first time """
+    global _karma_tiers
 
-    for p in posts_to_delete:
-        del _our_posts[p]
+    if not _karma_tiers:
+        _karma_tiers = sorted(tuple(int(v) for v in tier.split(':'))
+                              for tier in config.get_list('karma_tiers'))
+    return _karma_tiers
 
 
 def _get_our_posts(timeframe, r):
-    """ called when bot starts up; adds all of our posts in the timeframe to 
-        _our_posts and the posts we replied to to _searched (so we don't
+    """ called when bot starts up if reconcile_on_startup is set; adds all of
+        our posts in the timeframe to _our_posts and the posts we replied to
+        to _searched, catching anything the saved state missed (so we don't
         duplicate posts if the bot restarts for any reason) """
 
-    user = r.get_redditor(config['username'])
+    user = r.get_redditor(_get_login()['username'])
     comments = user.get_comments(limit=200)
 
     for comment in comments:
@@ -311,19 +1001,43 @@ def _get_our_posts(timeframe, r):
             break
 
         # we're going to cheat a little and assume our posts was the same
-        #   hour as the post it replied to
-        hour = _get_hour(comment.created_utc)
-        if hour not in _searched:
-            _searched[hour] = []
-
+        #   time as the post it replied to
         if '_' in comment.parent_id:
-            _searched[hour].append(comment.parent_id.split('_')[1])
+            parent_id = comment.parent_id.split('_')[1]
         else:
-            _searched[hour].append(comment.parent_id)
+            parent_id = comment.parent_id
+        if not _searched.contains(parent_id, comment.created_utc):
+            _searched.add(parent_id, comment.created_utc)
+            state.save_searched(parent_id, comment.created_utc)
+
+        if comment.id not in _our_posts:
+            _our_posts[comment.id] = {  'timestamp': comment.created_utc,
+                                        's_id': comment.submission.id }
+            state.save_our_post(comment.id, comment.submission.id,
+                                comment.created_utc)
+    state.flush()
+
+
+def _load_state():
+    """ called when bot starts up; loads the state saved by the last run into
+        _searched, _replied_to, _our_posts and _failed_posts """
+
+    saved = state.load()
+    for post_id, created in saved['searched']:
+        _searched.add(post_id, created)
+    _searched.expire()
+    with _state_lock:
+        _replied_to.update(saved['replied'])
+        _our_posts.update(saved['our_posts'])
+        _failed_posts.update(saved['failed'])
+    logger.info('Loaded state: {s} searched, {o} of our posts'.format(
+                                                    s=len(_searched),
+                                                    o=len(_our_posts)))
+
 
-        _our_posts[comment.id] = {  'timestamp': comment.created_utc,
-                                    's_id': comment.submission.id }
+metrics.register_gauge('pipeline.depth', lambda: get_stage_latency()['depth'])
 
 
 if __name__ == '__main__':
+    atexit.register(state.flush)
     run()
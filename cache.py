@@ -0,0 +1,239 @@
+import time
+import atexit
+import sqlite3
+import threading
+import utils
+import logger
+import metrics
+
+config = utils.get_config_params('cache')
+
+# cache hit/miss counters, see get_stats()
+_stats = { 'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0 }
+
+# serializes use of the connection between fetch threads
+_lock = threading.Lock()
+
+# the cache database connection, opened with the first lookup and kept
+_db = None
+
+# total size of the cached responses in bytes, so a put doesn't have to sum
+#   the table; read from the table when the connection is opened and again
+#   after each eviction (other processes may share the table)
+_size = 0
+
+# access times of cache hits not yet written to the table
+#      key: cache key
+#      value: timestamp
+#   written in one batch by the next put, or once there are _ACCESS_BATCH
+_accessed = {}
+_ACCESS_BATCH = 100
+
+def get(region, path, kind):
+    """ given a region, api path and endpoint kind (profile, hero, item or
+        base_item), return the cached response text or None if it isn't
+        cached or is older than the ttl for that kind """
+
+    ttl = _get_ttl(kind)
+    if ttl <= 0:
+        return None
+
+    key = _get_key(region, path)
+    with _lock:
+        try:
+            db = _connect()
+            table = config['table']
+            now = time.time()
+
+            query = 'SELECT data, created, size FROM {t} WHERE key=?'
+            row = db.execute(query.format(t=table), (key,)).fetchone()
+
+            metrics.incr('sqlite.queries')
+            if not row:
+                _stats['misses'] += 1
+                return None
+
+            if row[1] < now - ttl:
+                _delete(db, [(key, row[2])])
+                db.commit()
+                _stats['misses'] += 1
+                _stats['expired'] += 1
+                return None
+
+            # a hit is only a read; the access time is written later
+            _accessed[key] = now
+            if len(_accessed) >= _ACCESS_BATCH:
+                _write_accessed(db)
+                db.commit()
+            _stats['hits'] += 1
+            return row[0]
+        except sqlite3.Error, e:
+            logger.error('SQLite3 Error in cache.get: {e}'.format(e=e.args[0]))
+            _reset()
+
+    return None
+
+def put(region, path, kind, data):
+    """ given a region, api path, endpoint kind and the response text, store
+        the response; least recently used entries are evicted once the cache
+        grows past max_size bytes """
+    global _size
+
+    if _get_ttl(kind) <= 0:
+        return
+
+    key = _get_key(region, path)
+    with _lock:
+        try:
+            db = _connect()
+            table = config['table']
+            now = time.time()
+
+            query = 'SELECT size FROM {t} WHERE key=?'
+            row = db.execute(query.format(t=table), (key,)).fetchone()
+            query = 'INSERT OR REPLACE INTO {t}(key,kind,data,size,created,' \
+                    'accessed) VALUES(?,?,?,?,?,?)'
+            db.execute(query.format(t=table),
+                       (key, kind, data, len(data), now, now))
+            metrics.incr('sqlite.queries', 2)
+            _accessed.pop(key, None)
+            _size += len(data) - (row[0] if row else 0)
+
+            _write_accessed(db)
+            if _size > config.get_int('max_size'):
+                _evict(db)
+            db.commit()
+        except sqlite3.Error, e:
+            logger.error('SQLite3 Error in cache.put: {e}'.format(e=e.args[0]))
+            _reset()
+
+def get_stats():
+    """ return a dictionary of cache counters (hits, misses, expired,
+        evicted) along with the hit rate """
+
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+    return stats
+
+
+def _evict(db):
+    """ given the db connection, delete the least recently used entries until
+        the cache is at or under max_size bytes; expects _lock to be held and
+        the access times to be written """
+    global _size
+
+    table = config['table']
+    # other processes may have changed the table, so start from its real size
+    _size = _get_table_size(db)
+    excess = _size - config.get_int('max_size')
+    if excess <= 0:
+        return
+
+    query = 'SELECT key, size FROM {t} ORDER BY accessed'
+    to_delete = []
+    for key, size in db.execute(query.format(t=table)):
+        if excess <= 0:
+            break
+        to_delete.append((key, size))
+        excess -= size
+    metrics.incr('sqlite.queries')
+
+    _delete(db, to_delete)
+    _stats['evicted'] += len(to_delete)
+    logger.debug('Evicted {n} cached responses', n=len(to_delete))
+
+def _delete(db, entries):
+    """ given the db connection and a list of (key, size), delete those
+        entries; expects _lock to be held """
+    global _size
+
+    query = 'DELETE FROM {t} WHERE key=?'
+    db.executemany(query.format(t=config['table']),
+                   [(key,) for key, size in entries])
+    metrics.incr('sqlite.queries')
+    for key, size in entries:
+        _accessed.pop(key, None)
+        _size -= size
+
+def _write_accessed(db):
+    """ given the db connection, write the access times of recent hits in one
+        batch; expects _lock to be held """
+
+    if not _accessed:
+        return
+    query = 'UPDATE {t} SET accessed=? WHERE key=?'
+    db.executemany(query.format(t=config['table']),
+                   [(accessed, key) for key, accessed in _accessed.iteritems()])
+    metrics.incr('sqlite.queries')
+    _accessed.clear()
+
+def _get_table_size(db):
+    """ given the db connection, return the total size of the cached
+        responses """
+    query = 'SELECT total(size) FROM {t}'
+    metrics.incr('sqlite.queries')
+    return int(db.execute(query.format(t=config['table'])).fetchone()[0])
+
+def _connect():
+    """ return the connection to the cache database, opening it (and creating
+        the cache table) the first time through; expects _lock to be held """
+    global _db, _size
+
+    if _db is None:
+        db = sqlite3.connect(config['database'], timeout=30,
+                             check_same_thread=False)
+        table = config['table']
+        db.execute('CREATE TABLE IF NOT EXISTS {t}(key TEXT PRIMARY KEY, '
+                   'kind TEXT, data TEXT, size INTEGER, created REAL, '
+                   'accessed REAL)'.format(t=table))
+        db.execute('CREATE INDEX IF NOT EXISTS {t}_accessed ON {t}(accessed)'
+                   .format(t=table))
+        db.commit()
+        _size = _get_table_size(db)
+        _db = db
+    return _db
+
+def _reset():
+    """ roll back and close the connection after an error, so the next call
+        starts with a fresh one; expects _lock to be held """
+    global _db
+
+    utils.rollback_db(_db)
+    utils.close_db(_db)
+    _db = None
+    _accessed.clear()
+
+def close():
+    """ write any pending access times and close the connection; called at
+        exit """
+    global _db
+
+    with _lock:
+        if _db is None:
+            return
+        try:
+            _write_accessed(_db)
+            _db.commit()
+        except sqlite3.Error, e:
+            logger.error('SQLite3 Error in cache.close: {e}'.format(
+                                                            e=e.args[0]))
+            utils.rollback_db(_db)
+        utils.close_db(_db)
+        _db = None
+
+def _get_key(region, path):
+    """ given a region and api path, return the cache key """
+    return u'{r}:{p}'.format(r=region, p=path)
+
+def _get_ttl(kind):
+    """ given an endpoint kind, return its ttl in seconds (0 disables caching
+        for that kind, as does turning off enabled) """
+    if not config.get_bool('enabled'):
+        return 0
+    return config.get_int('{k}_ttl'.format(k=kind), 0)
+
+
+atexit.register(close)
+metrics.register_gauge('cache', get_stats)
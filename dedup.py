@@ -0,0 +1,64 @@
+import time
+import threading
+
+class DedupStore(object):
+    """ set of post ids bucketed by when the post was made, so whole buckets
+        can be dropped once they're older than max_age seconds.
+        with compact set, ids are stored as the integer value of their base36
+        reddit id instead of as strings """
+
+    def __init__(self, max_age, bucket_size=3600, compact=False):
+        self.max_age = max_age
+        self.bucket_size = bucket_size
+        self.compact = compact
+
+        # key: bucket number (epoch timestamp // bucket_size)
+        # value: set of post ids made in that bucket
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def add(self, post_id, timestamp):
+        """ add a post id made at the given timestamp """
+        bucket = self._get_bucket(timestamp)
+        with self._lock:
+            self._buckets.setdefault(bucket, set()).add(self._encode(post_id))
+
+    def discard(self, post_id, timestamp):
+        """ remove a post id made at the given timestamp, if we have it """
+        bucket = self._get_bucket(timestamp)
+        with self._lock:
+            if bucket in self._buckets:
+                self._buckets[bucket].discard(self._encode(post_id))
+
+    def contains(self, post_id, timestamp):
+        """ return true if we have the post id made at the given timestamp """
+        bucket = self._get_bucket(timestamp)
+        with self._lock:
+            return self._encode(post_id) in self._buckets.get(bucket, ())
+
+    def expire(self, now=None):
+        """ drop every bucket that ended more than max_age seconds ago;
+            returns the number of post ids dropped """
+
+        if now is None:
+            now = time.time()
+        oldest = self._get_bucket(now - self.max_age)
+        dropped = 0
+        with self._lock:
+            for bucket in [b for b in self._buckets if b < oldest]:
+                dropped += len(self._buckets.pop(bucket))
+        return dropped
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(ids) for ids in self._buckets.itervalues())
+
+    def _get_bucket(self, timestamp):
+        """ given a timestamp, return its bucket number """
+        return int(timestamp // self.bucket_size)
+
+    def _encode(self, post_id):
+        """ given a post id, return the form we store it in """
+        if self.compact:
+            return int(post_id, 36)
+        return post_id
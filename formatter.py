@@ -1,240 +1,363 @@
-import sqlite3
+import string
 import utils
 import logger
+import metadata
+import metrics
 
 config = utils.get_config_params('formatter')
 
-def format_gear(gear):
-    """ given a dictionary of gear { item_slot: { item_info } }, return
-        a formatted string to send to a reddit post """
-
-    items = {}
-    intro = '\n\n######&nbsp;\n\n****\n**Equipped Gear:**\n\n'
-
-    try:
-        # open a db connection
-        db = sqlite3.connect(config['database'])
-        db.row_factory = sqlite3.Row
-        db_cur = db.cursor()
-        table = config['item_table']
-        query = 'SELECT * FROM {t} WHERE name=\'{s}\''
-
-        # get the max order here (useful to remove secondary effects, etc)
-        max_order = int(config['max_order'])
-
-        for slot in gear:
-            name = _create_url(gear[slot]['name'], gear[slot]['url'])
-            i_type = gear[slot]['type']
-            item_info = u'> **{n} ({t})**'.format(n=name, t=i_type)
-            # because blizzard randomly uses a non-standard apostrophe sometimes
-            item_info = item_info.replace(u'\u2019', '\'')
-
-            d_stats = {}
-            for stat in gear[slot]['stats']:
-                db_cur.execute(query.format(t=table, s=stat['name']))
-                row = db_cur.fetchone()
-                if row['display'] and row['disp_order'] < max_order:
-                    # we send the min AND max values; min is generally only one 
-                    #   that is shown and matters, but a few stats need both
-                    a_min = stat['min']
-                    a_max = stat['max']
-                    order = row['disp_order']
-                    display = row['display'].format(a_min, a_max)
-                    d_stats[order] = display
-
-            # add all gems together (if possible) and display them
-            if 'gems' in gear[slot]:
-                gem_data = {}
-                for gem in gear[slot]['gems']:
-                    attr_name = gem['attr']
-                    if attr_name in gem_data:
-                        gem_data[attr_name] += gem['val']
-                    else:
-                        gem_data[attr_name] = gem['val']
-
-                d_count = max_order + 1
-                for attr in gem_data:
-                    db_cur.execute(query.format(t=table, s=attr))
-                    row = db_cur.fetchone()
-                    if row['display']:
-                        a_min = gem_data[attr]
-                        display = row['display'].format(a_min)
-
-                        d_stats[d_count] = '{d} (gems)'.format(d=display)
-                        d_count += 1
-
-
-            stat_text = ' | '.join([d_stats[s] for s in sorted(d_stats)])
-            item_stats = ''.join(('> ', stat_text))
-            
-            passive_text = ' | '.join(p for p in gear[slot]['passives'])
-            if passive_text:
-                item_pass = ''.join(('> ', _italic_superscript(passive_text)))
+# section headers
+_GEAR_HEADER = u'\n\n######&nbsp;\n\n****\n**Equipped Gear:**\n\n'
+_STATS_HEADER = u'\n\n######&nbsp;\n\n****\n**Character Stats:**\n\n'
+_SKILLS_HEADER = u'\n'.join((
+                    u'\n\n######&nbsp;\n\n****\n**Character Skills:**\n\n',
+                    u'> **Active:**\n',
+                    u'> | | | | | | |',
+                    u'> |:-:|:-:|:-:|:-:|:-:|:-:|',
+                    u''))
+_PASSIVE_HEADER = u'\n'.join((
+                    u'',
+                    u'\n> **Passive:**\n',
+                    u'> | | | | |',
+                    u'> |:-:|:-:|:-:|:-:|',
+                    u''))
+
+# compiled display templates
+#      key: display string from the stat tables ('{:,.0f}%', etc)
+#      value: function formatting the values the same way display.format does
+_templates = {}
+
+# superscript text we've already converted, see _super
+#      key: (text, italic)
+#      value: converted text
+_superscripts = {}
+_MAX_SUPERSCRIPTS = 1000
+
+# the footer never changes, so it's only built once by _get_outro
+_outro = None
+
+def format_profile(profile):
+    """ given a profile dictionary (created by profiler.get_profile), return
+        the full formatted text profile.  each section is timed under the
+        name of its format_* function """
+
+    with metrics.timer('formatter.format_profile'):
+        post = []
+        with metrics.timer('formatter.format_intro'):
+            _add_intro(post, profile['intro'])
+        with metrics.timer('formatter.format_gear'):
+            _add_gear(post, profile['gear'])
+        with metrics.timer('formatter.format_stats'):
+            _add_stats(post, profile['stats'], profile['gear_stats'])
+        with metrics.timer('formatter.format_skills'):
+            _add_skills(post, profile['skills'])
+        with metrics.timer('formatter.format_outro'):
+            post.append(_get_outro())
+
+        return u''.join(post)
+
+def reload():
+    """ forget anything built from the config settings; called after the
+        config file is reloaded """
+    global _outro
+    _outro = None
+
+@metrics.timed('formatter.format_career')
+def format_career(career):
+    """ given a career dictionary (created by profiler.get_career), return a
+        summary table of its heroes, one row each, with the summary_stats from
+        the config file """
+
+    stat_names = config.get_list('summary_stats')
+    rows = [metadata.get_hero_stat(stat) for stat in stat_names]
+    headings = [row['disp_name'] if row and row['disp_name'] else stat
+                for stat, row in zip(stat_names, rows)]
+
+    summary = [u'### **Heroes of {b}**\n\n'.format(b=career['battle_tag'])]
+    summary.append(u'|'.join([u'Hero', u'Class', u'Level'] + headings))
+    summary.append(u'\n')
+    summary.append(u'|'.join([u':--'] * 3 + [u'--:'] * len(headings)))
+    summary.append(u'\n')
+
+    for profile in career['heroes']:
+        intro = profile['intro']
+        h_class = u' '.join(filter(None, (intro['hardcore'], intro['class'])))
+        cells = [_create_url(intro['name'], intro['url']), h_class,
+                 u'{l} (PL {pl})'.format(l=intro['level'],
+                                         pl=intro['paragon_level'])]
+        for stat, row in zip(stat_names, rows):
+            val = profile['stats'].get(stat, 0)
+            if row and row['display']:
+                cells.append(_get_template(row['display'])(val))
             else:
-                item_pass = ''
+                cells.append(u'{v}'.format(v=val))
+        summary.append(u'|'.join(cells))
+        summary.append(u'\n')
 
-            items[slot] = '    \n'.join((item_info, item_stats, item_pass))
-    except sqlite3.Error, e:
-        logger.error('SQLite3 Error in get_gear: {e}'.format(e=e.args[0]))
-        utils.rollback_db(db)
-    finally:
-        utils.close_db(db)
+    summary.append(_get_outro())
+    return u''.join(summary)
 
-    # get the order we want gear to display
-    slot_disp = config['item_display_order'].split(',')
-
-    disp = []
-    for slot in slot_disp:
-        if slot in items:
-            disp.append(items[slot])
-
-    stats = u'\n\n'.join(disp)
-    return u''.join((intro, stats))
+@metrics.timed('formatter.format_gear')
+def format_gear(gear):
+    """ given a dictionary of gear { item_slot: records.Item }, return
+        a formatted string to send to a reddit post """
+    text = []
+    _add_gear(text, gear)
+    return u''.join(text)
 
+@metrics.timed('formatter.format_stats')
 def format_stats(stats, gear_stats=None):
-    """ given a dictionary of {'stat': value}, return a formatted string to 
+    """ given a dictionary of {'stat': value}, return a formatted string to
         send to a reddit post """
+    text = []
+    _add_stats(text, stats, gear_stats)
+    return u''.join(text)
 
-    intro = '\n\n######&nbsp;\n\n****\n**Character Stats:**\n\n'
-    try:
-        # open a db connection
-        db = sqlite3.connect(config['database'])
-        db.row_factory = sqlite3.Row
-        db_cur = db.cursor()
-        table = config['stats_table']
-        query = 'SELECT * FROM {t} WHERE name=\'{s}\''
-
-        char_stats = {}
-        max_val_len = 0
-        max_name_len = 0
-        stat_text = []
-
-        for stat in stats:
-            db_cur.execute(query.format(t=table, s=stat))
-            row = db_cur.fetchone()
-            if row['display'] and row['disp_name']:
-                val = stats[stat]
+@metrics.timed('formatter.format_skills')
+def format_skills(skills):
+    """ given a dictionary of:
+        { 'active': [ records.Skill, ... ], 'passive': [ records.Skill, ... ] }
+        return a fromatted string ready to post to reddit """
+    text = []
+    _add_skills(text, skills)
+    return u''.join(text)
+
+@metrics.timed('formatter.format_intro')
+def format_intro(hero_info):
+    """ given a dictionary of hero info, return a formatted intro string ready
+        to post to reddit """
+    text = []
+    _add_intro(text, hero_info)
+    return u''.join(text)
+
+@metrics.timed('formatter.format_outro')
+def format_outro():
+    """ return a footer string formatted for reddit post """
+    return _get_outro()
+
+
+def _add_gear(text, gear):
+    """ append the formatted gear section to the text list """
+
+    text.append(_GEAR_HEADER)
+
+    # get the max order here (useful to remove secondary effects, etc)
+    max_order = config.get_int('max_order')
+
+    # go through the gear in the order we want it displayed
+    first = True
+    for slot in config.get_list('item_display_order'):
+        if slot not in gear:
+            continue
+        item = gear[slot]
+
+        d_stats = {}
+        for stat in item.stats:
+            row = metadata.get_item_stat(stat.name)
+            if row and row['display'] and row['disp_order'] < max_order:
+                # we send the min AND max values; min is generally only one
+                #   that is shown and matters, but a few stats need both
+                display = _get_template(row['display'])
+                d_stats[row['disp_order']] = display(stat.min, stat.max)
+
+        # add all gems together (if possible) and display them
+        if item.gems:
+            gem_data = {}
+            for gem in item.gems:
+                attr_name = gem.attr
+                if attr_name in gem_data:
+                    gem_data[attr_name] += gem.val
+                else:
+                    gem_data[attr_name] = gem.val
+
+            d_count = max_order + 1
+            for attr in gem_data:
+                row = metadata.get_item_stat(attr)
+                if row and row['display']:
+                    display = _get_template(row['display'])
+                    d_stats[d_count] = display(gem_data[attr]) + u' (gems)'
+                    d_count += 1
+
+        if not first:
+            text.append(u'\n\n')
+        first = False
+
+        # because blizzard randomly uses a non-standard apostrophe sometimes
+        text.extend((u'> **', _fix_apostrophe(_create_url(item.name,
+                                                          item.url)),
+                     u' (', _fix_apostrophe(item.type), u')**    \n> ',
+                     u' | '.join([d_stats[s] for s in sorted(d_stats)]),
+                     u'    \n'))
+
+        passive_text = u' | '.join(item.passives)
+        if passive_text:
+            text.append(u'> ')
+            text.append(_super(passive_text, italic=True))
+
+def _add_stats(text, stats, gear_stats):
+    """ append the formatted character stats section to the text list """
+
+    text.append(_STATS_HEADER)
+
+    char_stats = {}
+    max_name_len = 0
+
+    sources = [(stats, False)]
+    if gear_stats:
+        sources.append((gear_stats, True))
+
+    for values, from_gear in sources:
+        for stat in values:
+            row = metadata.get_hero_stat(stat)
+            if row and row['display'] and row['disp_name']:
+                val = values[stat]
+                # crit has a base of 5%; add it here
+                if from_gear and stat == 'Crit_Percent_Bonus_Capped':
+                    val += 5
                 # don't display stats at 0 or the low primary stats
                 if val == 0 or (row['primary_stat'] == 1 and val < 100):
                     continue
-                disp_val = row['display'].format(val)
-                order = row['disp_order']
                 disp_name = row['disp_name']
-                char_stats[order] = ( disp_name, disp_val )
-                if len(disp_val) > max_val_len:
-                    max_val_len = len(disp_val)
+                char_stats[row['disp_order']] = (
+                                    disp_name,
+                                    _get_template(row['display'])(val) )
                 if len(disp_name) > max_name_len:
                     max_name_len = len(disp_name)
 
-        if gear_stats:
-            for stat in gear_stats:
-                db_cur.execute(query.format(t=table, s=stat))
-                row = db_cur.fetchone()
-                if row['display'] and row['disp_name']:
-                    val = gear_stats[stat]
-                    # crit has a base of 5%; add it here
-                    if stat == 'Crit_Percent_Bonus_Capped':
-                        val += 5
-                    # don't display stats at 0 or the low primary stats
-                    if val == 0 or (row['primary_stat'] == 1 and val < 100):
-                        continue
-                    disp_val = row['display'].format(val)
-                    order = row['disp_order']
-                    disp_name = row['disp_name']
-                    char_stats[order] = ( disp_name, disp_val )
-                    if len(disp_val) > max_val_len:
-                        max_val_len = len(disp_val)
-                    if len(disp_name) > max_name_len:
-                        max_name_len = len(disp_name)
-
-
-        for order in sorted(char_stats):
-            name = char_stats[order][0]
-            val = char_stats[order][1]
-            sp = ' ' * (max_name_len - len(name))
-            stat_text.append('  '.join(('  ', sp, name, val, '\n')))
-
-        return u''.join((intro, u''.join(stat_text)))
-
-    except sqlite3.Error, e:
-        logger.error('SQLite3 Error in get_gear: {e}'.format(e=e.args[0]))
-        utils.rollback_db(db)
-    finally:
-        utils.close_db(db)
+    for order in sorted(char_stats):
+        name, val = char_stats[order]
+        sp = u' ' * (max_name_len - len(name))
+        text.extend((u'    ', sp, u'  ', name, u'  ', val, u'  \n'))
 
-def format_skills(skills):
-    """ given a dictionary of:
-        { 'active': [{ 'name': skill name, 'rune': rune name, 'url': url },...],
-          'passive': [{ 'name': s1, 'url': url }, ... ] }
-        return a fromatted string ready to post to reddit """
-    skills_table = []
-    skills_table.append('\n\n######&nbsp;\n\n****\n**Character Skills:**\n\n')
-
-    skills_table.append('> **Active:**\n')
-    skills_table.append('> | | | | | | |')
-    skills_table.append('> |:-:|:-:|:-:|:-:|:-:|:-:|')
-    active = ['> |']
-    rune = ['> |']
-    for skill in skills['active']:
-        skill_name = _create_url(skill['name'], skill['url'])
-        active.append('{s}|'.format(s=skill_name))
-        rune.append('{r}|'.format(r=skill['rune']))
-    skills_table.append(u''.join(active))
-    skills_table.append(u''.join(rune))
-
-    skills_table.append('\n> **Passive:**\n')
-    skills_table.append('> | | | | |')
-    skills_table.append('> |:-:|:-:|:-:|:-:|')
-    passive = ['> |']
-    for skill in skills['passive']:
-        skill_name = _create_url(skill['name'], skill['url'])
-        passive.append('{s}|'.format(s=skill_name))
-    skills_table.append(u''.join(passive))
+def _add_skills(text, skills):
+    """ append the formatted skills section to the text list """
 
-    return u'\n'.join(skills_table)
+    text.append(_SKILLS_HEADER)
 
-def format_intro(hero_info):
-    """ given a dictionary of hero info, return a formatted intro string ready
-        to post to reddit """
+    text.append(u'> |')
+    for skill in skills['active']:
+        text.extend((_create_url(skill.name, skill.url), u'|'))
+    text.append(u'\n> |')
+    for skill in skills['active']:
+        text.extend((u'{r}'.format(r=skill.rune), u'|'))
 
-    name = _create_url(hero_info['name'], hero_info['url'])
-    level = hero_info['level']
-    p_level = hero_info['paragon_level']
-    hardcore = hero_info['hardcore']
-    h_class = hero_info['class']
-    intro = u'### **Text Profile for {n}** - {l} (PL {pl}) {hc} {c}'.format(
-                        n=name, l=level, pl=p_level, hc=hardcore, c=h_class )
-    return intro
+    text.append(_PASSIVE_HEADER)
 
-def format_outro():
-    """ return a footer string formatted for reddit post """
+    text.append(u'> |')
+    for skill in skills['passive']:
+        text.extend((_create_url(skill.name, skill.url), u'|'))
 
-    message_me = _create_url('^message ^me', config['message_me'])
-    next_up = 'better stat layout; set bonuses'
-    outro = ['\n\n#&nbsp;\n']
-    outro.append(_super('bot is a work in progress | '))
-    outro.append(' {m} ^with ^suggestions '.format(m=message_me))
-    # outro.append(_super(' | next todo: {n}'.format(n=next_up)))
-    outro.append('    \n')
-    outro.append(_super('this post will remove itself at negative karma'))
+def _add_intro(text, hero_info):
+    """ append the formatted intro line to the text list """
 
-    return u''.join(outro)
+    name = _create_url(hero_info['name'], hero_info['url'])
+    intro = u'### **Text Profile for {n}** - {l} (PL {pl}) {hc} {c}'.format(
+                        n=name, l=hero_info['level'],
+                        pl=hero_info['paragon_level'],
+                        hc=hero_info['hardcore'], c=hero_info['class'] )
+    text.append(intro)
+
+def _get_outro():
+    """ return the footer, building it the first time through """
+
+    global _outro
+
+    if _outro is None:
+        message_me = _create_url('^message ^me', config['message_me'])
+        next_up = 'better stat layout; set bonuses'
+        outro = ['\n\n#&nbsp;\n']
+        outro.append(_super('bot is a work in progress | '))
+        outro.append(' {m} ^with ^suggestions '.format(m=message_me))
+        # outro.append(_super(' | next todo: {n}'.format(n=next_up)))
+        outro.append('    \n')
+        outro.append(_super('this post will remove itself at negative karma'))
+        _outro = u''.join(outro)
+    return _outro
+
+
+def _get_template(display):
+    """ given a display string from the stat tables, return a function that
+        formats values with it, compiling it the first time it's seen """
+
+    template = _templates.get(display)
+    if template is None:
+        template = _compile_template(display)
+        _templates[display] = template
+    return template
+
+def _compile_template(display):
+    """ given a display string, split it once into its literal text and
+        format specs so formatting a value is a format() call per field
+        rather than a full parse of the string; displays using anything
+        beyond positional fields and specs just use display.format """
+
+    parts = []
+    auto = 0
+    try:
+        for literal, field, spec, conversion in \
+                string.Formatter().parse(display):
+            if field is None:
+                parts.append((literal, None, None))
+                continue
+            if conversion or (field and not field.isdigit()) or \
+                    (spec and '{' in spec):
+                return display.format
+            if field:
+                index = int(field)
+            else:
+                index = auto
+                auto += 1
+            parts.append((literal, index, spec))
+    except ValueError, e:
+        logger.warn('Bad display template {d}: {e}'.format(d=display, e=e))
+        return display.format
+
+    # most displays are a single value with some text around it
+    if parts and parts[0][1] is not None and \
+            (len(parts) == 1 or len(parts) == 2 and parts[1][1] is None):
+        literal, index, spec = parts[0]
+        suffix = parts[1][0] if len(parts) == 2 else u''
+        return lambda *values: u''.join((literal,
+                                         format(values[index], spec),
+                                         suffix))
+
+    def template(*values):
+        text = []
+        for literal, index, spec in parts:
+            text.append(literal)
+            if index is not None:
+                text.append(format(values[index], spec))
+        return u''.join(text)
+    return template
 
 
 def _create_url(text, url):
     """ given text and a url, create the reddit version of a link.  if the url
-        is set to None, just return the text """
+        is set to None, just return the text (None for an empty skill slot
+        comes back as 'None', like any other value) """
 
     if not url:
-        return text
+        return u'{t}'.format(t=text)
     return u'[{t}]({u})'.format(t=text, u=url)
 
-def _italic_superscript(text):
-    """ given text, return the same text in italicized superscript format """
-    t =  u' ^'.join(text.split())
-    return u''.join(('*^', t, '*'))
-
-def _super(text):
-    """ given text, return superscript format """
-    t = u' ^'.join(text.split())
-    return u''.join(('^', t))
\ No newline at end of file
+def _fix_apostrophe(text):
+    """ replace blizzard's non-standard apostrophe with a plain one """
+    if u'\u2019' in text:
+        return text.replace(u'\u2019', '\'')
+    return text
+
+def _super(text, italic=False):
+    """ given text, return superscript (or italic superscript) format;
+        conversions are remembered since the same passives and footer come up
+        in most replies """
+
+    key = (text, italic)
+    converted = _superscripts.get(key)
+    if converted is None:
+        converted = u''.join(('^', u' ^'.join(text.split())))
+        if italic:
+            converted = u''.join(('*', converted, '*'))
+        if len(_superscripts) >= _MAX_SUPERSCRIPTS:
+            _superscripts.clear()
+        _superscripts[key] = converted
+    return converted
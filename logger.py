@@ -1,76 +1,216 @@
+import os
 import time
+import atexit
+import threading
+import Queue
 import traceback
 import utils
 
 config = utils.get_config_params('logging')
 
+# numerical log levels; anything below the configured level is dropped
+_LEVELS = {
+    'debug': 0,
+    'info': 1,
+    'warn': 2,
+    'error': 3,
+    'fatal': 4
+    }
+
+# the configured level, default value is 1 (info)
+_level = _LEVELS.get(config['log_level'], 1)
+
+# lines waiting for the writer thread
+_queue = Queue.Queue()
+
+# queued by flush to stop the writer thread
+_STOP = object()
+
+# the writer thread, started with the first entry
+_writer = None
+_writer_lock = threading.Lock()
+
+# open log file and when it was last flushed; guarded by _file_lock
+_file = None
+_last_flush = 0
+_file_lock = threading.Lock()
+
 def get_file_path():
     """ Returns the file path for the log file """
 
     file_path = (config['log_location'], config['log_file'])
     return '{path}/{file}'.format(path=file_path[0], file=file_path[1])
 
-def debug(entry):
-    """ Log entry if log_level is set to debug or lower """
+def reload_level():
+    """ resolve the configured log level again, after the config is reloaded """
+    global _level
+    _level = _LEVELS.get(config['log_level'], 1)
+
+def debug(entry, *args, **kwargs):
+    """ Log entry if log_level is set to debug or lower; any args/kwargs are
+        formatted into entry only if it is logged """
 
-    if _get_log_level() <= 0:
-        _log('DEBUG - {entry}'.format(entry=entry))
+    if _level <= 0:
+        _log('DEBUG', entry, args, kwargs)
 
-def info(entry):
+def info(entry, *args, **kwargs):
     """ Log entry if log_level is set to info or lower """
-    
-    if _get_log_level() <= 1:
-        _log('INFO - {entry}'.format(entry=entry))
 
-def warn(entry):
+    if _level <= 1:
+        _log('INFO', entry, args, kwargs)
+
+def warn(entry, *args, **kwargs):
     """ Log entry if log_level is set to warn or lower """
-    
-    if _get_log_level() <= 2:
-        _log('WARN - {entry}'.format(entry=entry))
 
-def error(entry):
+    if _level <= 2:
+        _log('WARN', entry, args, kwargs)
+
+def error(entry, *args, **kwargs):
     """ Log entry if log_level is set to error or lower """
-    
-    if _get_log_level() <= 3:
-        _log('ERROR - {entry}'.format(entry=entry))
 
-def fatal(entry):
+    if _level <= 3:
+        _log('ERROR', entry, args, kwargs)
+
+def fatal(entry, *args, **kwargs):
     """ Log entry if log_level is set to fatal or lower """
-    
-    if _get_log_level() <= 4:
-        _log('FATAL - {entry}'.format(entry=entry))
+
+    if _level <= 4:
+        _log('FATAL', entry, args, kwargs)
+
+def flush():
+    """ stop the writer thread and write out everything logged so far; called
+        at exit, so the writer isn't left polling the queue while the
+        interpreter tears down the modules it uses """
+
+    with _writer_lock:
+        writer = _writer
+    if writer and writer.is_alive():
+        _queue.put(_STOP)
+        writer.join(config.get_float('flush_interval') + 5)
+
+    with _file_lock:
+        while True:
+            try:
+                line = _queue.get_nowait()
+            except Queue.Empty:
+                break
+            if line is not _STOP:
+                _write(line)
+        _flush_file()
 
 
-def _log(entry):
-    """ Logs the entry with a timestamp in our log file """
-    
+def _log(level, entry, args, kwargs):
+    """ Queues the entry with a timestamp for the writer thread """
+
+    if args or kwargs:
+        try:
+            entry = entry.format(*args, **kwargs)
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            # a unicode value (battletags, etc) in a str entry, or a utf-8
+            #   str value in a unicode entry; format it all as unicode
+            entry = _to_unicode(entry).format(
+                        *[_to_unicode(arg) for arg in args],
+                        **dict((key, _to_unicode(value))
+                               for key, value in kwargs.iteritems()))
+    if isinstance(entry, unicode):
+        entry = entry.encode('utf-8')
+
     timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    _queue.put('{t} - {l} - {e}\n'.format(t=timestamp, l=level, e=entry))
+
+    if not _writer:
+        _start_writer()
+
+def _start_writer():
+    """ start the writer thread unless it's already running """
+    global _writer
+
+    with _writer_lock:
+        if _writer:
+            return
+        _writer = threading.Thread(target=_write_loop, name='logger')
+        _writer.daemon = True
+        _writer.start()
+
+def _write_loop():
+    """ writer thread; writes queued lines to the log file through a buffered
+        handle, flushing at least every flush_interval seconds """
+
+    interval = config.get_float('flush_interval')
+    while True:
+        try:
+            line = _queue.get(timeout=interval)
+        except Queue.Empty:
+            line = None
+        if line is _STOP:
+            return
+
+        # nothing should stop the writer, or everything logged after is lost
+        try:
+            with _file_lock:
+                if line:
+                    _write(line)
+                if time.time() - _last_flush >= interval:
+                    _flush_file()
+        except Exception:
+            pass
+
+def _write(line):
+    """ write a line to the log file, rotating it if it has grown past
+        max_bytes; expects _file_lock to be held """
+    global _file
+
+    try:
+        if not _file:
+            _file = open(get_file_path(), 'a')
+        _file.write(line)
+        if _file.tell() >= config.get_int('max_bytes'):
+            _rotate()
+    except Exception, e:
+        _write_error()
+
+def _flush_file():
+    """ flush the log file; expects _file_lock to be held """
+    global _last_flush
+
+    _last_flush = time.time()
     try:
-        loc = config['log_location']
-        filename = config['log_file']
-        file_path = get_file_path()
-        f = open(file_path, 'a')
-        f.write('{t} - {e}\n'.format(t=timestamp, e=str(entry)))
-        f.close()
+        if _file:
+            _file.flush()
     except Exception, e:
-        f = open('d3logging.err', 'a')
-        f.write('{t} -\n{tb}\n'.format(t=timestamp, tb=traceback.format_exc()))
-        f.close()
-        raise
-
-def _get_log_level():
-    """ returns the numerical value of the current log_level
-            debug = 0
-            info  = 1
-            warn  = 2
-            error = 3
-            fatal = 4
-        default value is 1
-    """
-    return {
-        'debug': 0,
-        'info': 1,
-        'warn': 2,
-        'error': 3,
-        'fatal': 4
-        }.get(config['log_level'], 1)
+        _write_error()
+
+def _rotate():
+    """ close the log file and shift it to .1 (.1 to .2, etc), keeping at most
+        backup_count old files; expects _file_lock to be held """
+    global _file
+
+    _file.close()
+    _file = None
+
+    path = get_file_path()
+    backups = config.get_int('backup_count')
+    if backups > 0:
+        for i in range(backups - 1, 0, -1):
+            old = '{p}.{i}'.format(p=path, i=i)
+            if os.path.exists(old):
+                os.rename(old, '{p}.{i}'.format(p=path, i=i + 1))
+        os.rename(path, '{p}.1'.format(p=path))
+    else:
+        os.remove(path)
+
+def _to_unicode(value):
+    """ given a log value, return it decoded if it's a str (utf-8) """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def _write_error():
+    """ record the current exception in d3logging.err """
+
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    f = open('d3logging.err', 'a')
+    f.write('{t} -\n{tb}\n'.format(t=timestamp, tb=traceback.format_exc()))
+    f.close()
+
+atexit.register(flush)
@@ -1,36 +1,238 @@
 import sys
+import time
+import random
+import socket
+import httplib
+import urllib
 import urllib2
+import urlparse
+import zlib
+import threading
+import Queue
+import copy
 import json
 import utils
 import logger
+import cache
+import metrics
 
 config = utils.get_config_params('d3_lookup')
 
-def _api_call(url, region):
+# idle keep-alive connections
+#      key: (host, port) of the regional api server
+#      value: Queue of httplib.HTTPConnection, at most pool_size
+_pools = {}
+_pools_lock = threading.Lock()
+
+# api calls in flight (or finished within coalesce_window seconds); callers
+#   asking for the same region and url share the one fetch
+#      key: (region, url)
+#      value: { 'event': set when finished, 'data': result,
+#               'done': time finished or None }
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+# coalescing counters, see get_coalesce_stats()
+_coalesce_stats = { 'calls': 0, 'shared': 0 }
+
+# redirects _fetch follows (to the same host) before giving up
+_MAX_REDIRECTS = 3
+_REDIRECTS = (301, 302, 303, 307)
+
+def _api_call(url, region, kind):
     """ make a call to the d3 api in the given region
-        returns a python dictionary (converted from the json returned) """
+        returns a python dictionary (converted from the json returned)
+        kind is the endpoint type (profile, hero, item or base_item) and
+        decides how long the response is cached for.
+        concurrent calls for the same region and url share a single fetch """
+
+    key = (region, url)
+    now = time.time()
+    window = config.get_float('coalesce_window')
+
+    with _in_flight_lock:
+        _coalesce_stats['calls'] += 1
+        flight = _in_flight.get(key)
+        if flight and flight['done'] and flight['done'] < now - window:
+            del _in_flight[key]
+            flight = None
+
+        if flight:
+            _coalesce_stats['shared'] += 1
+            leader = False
+        else:
+            flight = { 'event': threading.Event(), 'data': None, 'done': None }
+            _in_flight[key] = flight
+            leader = True
+
+    if not leader:
+        flight['event'].wait()
+        logger.debug('Shared: {u} in {r}', u=url, r=region)
+        metrics.observe('lookup.{k}'.format(k=kind), time.time() - now)
+        return copy.deepcopy(flight['data'])
+
+    try:
+        flight['data'] = _load(url, region, kind)
+    finally:
+        flight['done'] = time.time()
+        flight['event'].set()
+        with _in_flight_lock:
+            # only successful results are kept around for later callers
+            if window <= 0 or flight['data'] is None:
+                _in_flight.pop(key, None)
+            _prune_in_flight(flight['done'] - window)
+
+    metrics.observe('lookup.{k}'.format(k=kind), flight['done'] - now)
+    return copy.deepcopy(flight['data'])
+
+def get_coalesce_stats():
+    """ return a dictionary of { 'calls', 'shared', 'in_flight' }; shared is
+        the number of calls answered by another caller's fetch """
+
+    with _in_flight_lock:
+        stats = dict(_coalesce_stats)
+        stats['in_flight'] = len(_in_flight)
+    return stats
+
+def _prune_in_flight(cutoff):
+    """ drop finished calls that finished before the cutoff timestamp; expects
+        _in_flight_lock to be held """
+
+    for key in [k for k, f in _in_flight.iteritems()
+                if f['done'] and f['done'] < cutoff]:
+        del _in_flight[key]
+
+def _load(url, region, kind):
+    """ load the given api url from the cache or the d3 api; returns a python
+        dictionary or None if the call failed """
     base_url = config['base_url'].format(region=region)
     api_url = '{base}{url}'.format(base=base_url, url=url)
 
     try:
-        logger.debug('Loading: {url}'.format(url=api_url))
-        data = urllib2.urlopen(api_url).read()
-        data = json.loads(data)
+        raw = cache.get(region, url, kind)
+        if raw is not None:
+            logger.debug('Cached: {url}', url=api_url)
+            return json.loads(raw)
+
+        logger.debug('Loading: {url}', url=api_url)
+        with metrics.timer('lookup.{k}.fetch'.format(k=kind)):
+            raw = _fetch(api_url)
+        data = json.loads(raw)
 
         # api error returend
         if 'code' in data:
             reason = data['reason']
             logger.warn('API error: {r} on {url}'.format(r=reason, url=api_url))
             return None
+
+        cache.put(region, url, kind, raw.decode('utf-8'))
         return data
     except urllib2.HTTPError, e:
         error = e.code
         logger.error('HTTP error: {e} on {url}'.format(e=error, url=api_url))
-    except urllib2.URLError, e:
-        error = e.reason.args[1]
+    except (socket.error, httplib.HTTPException), e:
+        error = str(e) or e.__class__.__name__
         logger.error('Network error: {e} on {url}'.format(e=error, url=api_url))
+    except ValueError, e:
+        logger.error('Invalid response: {e} on {url}'.format(e=e, url=api_url))
+    metrics.incr('lookup.{k}.errors'.format(k=kind))
     return None
 
+def _fetch(api_url):
+    """ GET the given url over a pooled keep-alive connection and return the
+        (decompressed) response body.  5xx responses are retried up to
+        max_retries times with jittered backoff and redirects to the same
+        host are followed up to _MAX_REDIRECTS times; any other status outside
+        2xx raises urllib2.HTTPError and network failures raise socket.error
+        or httplib.HTTPException """
+
+    parsed = urlparse.urlsplit(api_url)
+    host = (parsed.hostname, parsed.port or httplib.HTTP_PORT)
+    path = urllib.quote(parsed.path.encode('utf-8'), safe='/%')
+    if parsed.query:
+        path = '{p}?{q}'.format(p=path, q=parsed.query)
+    headers = { 'Accept-Encoding': 'gzip', 'Connection': 'keep-alive' }
+
+    max_retries = config.get_int('max_retries')
+    attempt = 0
+    redirects = 0
+    while True:
+        conn, reused = _get_connection(host)
+        metrics.incr('lookup.http_requests')
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            # the server may have dropped an idle keep-alive connection;
+            #   try once more on a fresh one before giving up
+            if reused:
+                continue
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            _release_connection(host, conn)
+
+        if response.status >= 500 and attempt < max_retries:
+            attempt += 1
+            delay = config.get_float('retry_backoff') * 2 ** (attempt - 1)
+            delay = random.uniform(delay / 2, delay)
+            logger.warn('HTTP {s} on {u}, retry {a} in {d:.2f}s'.format(
+                                s=response.status, u=api_url, a=attempt,
+                                d=delay))
+            time.sleep(delay)
+            continue
+
+        location = response.getheader('location')
+        if response.status in _REDIRECTS and location and \
+                redirects < _MAX_REDIRECTS:
+            target = urlparse.urlsplit(urlparse.urljoin(api_url, location))
+            if (target.hostname, target.port or httplib.HTTP_PORT) == host:
+                redirects += 1
+                api_url = target.geturl()
+                path = urllib.quote(target.path.encode('utf-8'), safe='/%')
+                if target.query:
+                    path = '{p}?{q}'.format(p=path, q=target.query)
+                logger.debug('Redirected to {u}', u=api_url)
+                continue
+
+        if not 200 <= response.status < 300:
+            raise urllib2.HTTPError(api_url, response.status, response.reason,
+                                    response.msg, None)
+
+        if response.getheader('content-encoding', '') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+def _get_connection(host):
+    """ given a (host, port), return a tuple of (connection, reused) where
+        reused is true if the connection came from the keep-alive pool """
+
+    with _pools_lock:
+        pool = _pools.setdefault(host, Queue.Queue(config.get_int('pool_size')))
+    try:
+        return pool.get_nowait(), True
+    except Queue.Empty:
+        pass
+
+    conn = httplib.HTTPConnection(host[0], host[1],
+                                  timeout=config.get_float('connect_timeout'))
+    conn.connect()
+    conn.sock.settimeout(config.get_float('read_timeout'))
+    return conn, False
+
+def _release_connection(host, conn):
+    """ return a connection to the keep-alive pool for its host, closing it if
+        the pool is already full """
+
+    try:
+        _pools[host].put_nowait(conn)
+    except Queue.Full:
+        conn.close()
+
 def hero_lookup(profile, hero=None, hero_id=None, region='us'):
     """ look up a profile and return the hero data.
         if hero_id is provided, use that.  if hero name is provided, find the
@@ -40,23 +242,33 @@ def hero_lookup(profile, hero=None, hero_id=None, region='us'):
 
     if not hero_id:
         hero_id = _get_hero_id(profile, region, hero)
+        if not hero_id:
+            return None
     api_url = 'profile/{profile}/hero/{id}'.format(profile=profile, id=hero_id)
 
     # add the profile data to the dictionary, we'll need it later
-    info = _api_call(api_url, region=region)
-    info['profile'] = profile
+    info = _api_call(api_url, region=region, kind='hero')
+    if info:
+        info['profile'] = profile
     return info
 
+def profile_lookup(profile, region='us'):
+    """ given a profile (battletag), return the career profile data; its
+        'heroes' list is sorted by level, then most recently played """
+    api_url = 'profile/{profile}/'.format(profile=profile)
+
+    return _api_call(api_url, region=region, kind='profile')
+
 def _get_hero_id(profile, region, hero_name=None):
     """ get the hero id for the given profile
         if hero name is provided, return the id for the highest level, most
         recently played match. if not, use the highest level, most recently 
         played hero """
 
-    api_url = 'profile/{profile}/'.format(profile=profile)
-    data = _api_call(api_url, region=region)
+    data = profile_lookup(profile, region=region)
 
-    if data:
+    # a profile without heroes has no heroes field at all
+    if data and data.get('heroes'):
         if hero_name:
             matches = {}
             matched_level = 0
@@ -83,13 +295,25 @@ def item_lookup(item, is_item_name=False, region='us'):
         expects a tooltipParam type item string (item/Cr0BCLqtqLoEEgcIB...)
         if the item is an actual blizzard item name ("Mempo's Twilight",
         "Rabid Strike", etc), set is_item_name to True convert """
+    kind = 'item'
     if is_item_name:
         item = _convert_item_name(item)
+        kind = 'base_item'
     api_url = 'data/{item_url}'.format(item_url=item)
 
-    return _api_call(api_url, region=region)
+    return _api_call(api_url, region=region, kind=kind)
+
+def base_item_lookup(item_id, region='us'):
+    """ given a base item id (Unique_Helm_002_x1, etc), return the base item
+        data """
+    api_url = 'data/item/{item_id}'.format(item_id=item_id)
+
+    return _api_call(api_url, region=region, kind='base_item')
 
 def _convert_item_name(item):
     """ converts an item name into one that blizzard api understands """
     item = item.lower().replace('-','').replace(' ','-').replace('\'', '')
-    return 'item/{item}'.format(item=item)
\ No newline at end of file
+    return 'item/{item}'.format(item=item)
+
+
+metrics.register_gauge('lookup.coalesce', get_coalesce_stats)
@@ -0,0 +1,212 @@
+import zlib
+import sqlite3
+import threading
+import utils
+import logger
+import metrics
+
+config = utils.get_config_params('metadata')
+
+# item stats (item_table), loaded once
+#      key: attribute name (API form)
+#      value: dictionary of the row { 'name', 'display', 'multiplier',
+#                                     'disp_order' }
+_item_stats = None
+
+# hero stats (stats_table), loaded once
+#      key: stat name (API form)
+#      value: dictionary of the row { 'name', 'display', 'multiplier',
+#                                     'primary_stat', 'disp_order',
+#                                     'disp_name' }
+_hero_stats = None
+
+# integer ids for item stats, so gear records can hold an id instead of the
+#   name (see records); ids are never reassigned, even when the tables are
+#   reloaded
+#      _item_ids: { attribute name: id }
+#      _item_names: [ attribute name by id ]
+_item_ids = {}
+_item_names = []
+
+# checksums of the loaded tables, so a reload can tell if anything changed
+#      _checksum: every row as loaded
+#      _version: only what changes rendered replies (see _get_version)
+_checksum = None
+_version = None
+
+# attributes seen for the first time; written to item_table by flush()
+_pending = []
+
+_lock = threading.Lock()
+_load_lock = threading.Lock()
+
+def load(tables=None):
+    """ load the item and hero stat tables into memory, replacing anything
+        loaded before; returns true if the tables differ from the last load in
+        a way that changes rendered replies.  given tables (a result of
+        read_tables) they're loaded as they are instead of read again """
+
+    global _item_stats, _hero_stats, _checksum, _version
+
+    if tables is None:
+        tables = read_tables()
+        if tables is None:
+            return False
+    item_stats, hero_stats, checksum = tables
+    version = _get_version(item_stats, hero_stats)
+
+    with _lock:
+        if checksum == _checksum:
+            return False
+        # attributes we've seen but not flushed yet aren't in the table
+        for name in _pending:
+            if name not in item_stats:
+                item_stats[name] = _item_stats[name]
+        for name in item_stats:
+            _set_item_id(name)
+        # swap both tables in at once
+        _item_stats, _hero_stats = item_stats, hero_stats
+        _checksum = checksum
+        changed = version != _version
+        _version = version
+    logger.info('Loaded {i} item stats and {h} hero stats'.format(
+                                                        i=len(item_stats),
+                                                        h=len(hero_stats)))
+    return changed
+
+def read_tables():
+    """ read the item and hero stat tables from the database without loading
+        them; returns (item stats, hero stats, checksum) to pass to load, or
+        None if they're the same as the tables already loaded """
+
+    db = None
+    try:
+        db = sqlite3.connect(config['database'], timeout=30)
+        db.row_factory = sqlite3.Row
+        db_cur = db.cursor()
+
+        query = 'SELECT * FROM {t}'
+        db_cur.execute(query.format(t=config['item_table']))
+        item_stats = dict((row['name'], dict(zip(row.keys(), row)))
+                          for row in db_cur.fetchall())
+        db_cur.execute(query.format(t=config['stats_table']))
+        hero_stats = dict((row['name'], dict(zip(row.keys(), row)))
+                          for row in db_cur.fetchall())
+        metrics.incr('sqlite.queries', 2)
+    except sqlite3.Error, e:
+        logger.error('SQLite3 Error in metadata.read_tables: {e}'.format(
+                                                                e=e.args[0]))
+        raise
+    finally:
+        utils.close_db(db)
+
+    checksum = zlib.crc32(repr((sorted(item_stats.iteritems()),
+                                sorted(hero_stats.iteritems()))))
+    if checksum == _checksum:
+        return None
+    return item_stats, hero_stats, checksum
+
+def get_item_stat(name):
+    """ given an attribute name, return its item_table row as a dictionary or
+        None if we haven't seen it """
+    if _item_stats is None:
+        _load_once()
+    return _item_stats.get(name)
+
+def get_hero_stat(name):
+    """ given a stat name, return its stats_table row as a dictionary or None
+        if we haven't seen it """
+    if _hero_stats is None:
+        _load_once()
+    return _hero_stats.get(name)
+
+def add_item_stat(name):
+    """ given an attribute name we haven't seen, add it with a multiplier of 1
+        and no display; it is written to the database on the next flush()
+        returns the new row """
+
+    if _item_stats is None:
+        _load_once()
+
+    with _lock:
+        if name in _item_stats:
+            return _item_stats[name]
+        logger.info('Adding {a} to {t}'.format(a=name, t=config['item_table']))
+        row = { 'name': name, 'display': None, 'multiplier': 1,
+                'disp_order': None }
+        _item_stats[name] = row
+        _set_item_id(name)
+        _pending.append(name)
+    return row
+
+def get_item_stat_id(name):
+    """ given an attribute name, return its integer id or None if we haven't
+        seen it """
+    if _item_stats is None:
+        _load_once()
+    return _item_ids.get(name)
+
+def get_item_stat_name(stat_id):
+    """ given an item stat id, return the attribute name """
+    return _item_names[stat_id]
+
+def get_version():
+    """ return the checksum of the parts of the loaded stat tables that change
+        rendered replies """
+    if _item_stats is None:
+        _load_once()
+    return _version
+
+def flush():
+    """ write any newly seen attributes to item_table in one batch """
+
+    with _lock:
+        if not _pending:
+            return
+        names = list(_pending)
+        del _pending[:]
+
+    db = None
+    try:
+        db = sqlite3.connect(config['database'], timeout=30)
+        query = 'INSERT INTO {t}(name,multiplier) VALUES(?,1)'
+        db.executemany(query.format(t=config['item_table']),
+                       [(name,) for name in names])
+        db.commit()
+        metrics.incr('sqlite.queries')
+    except sqlite3.Error, e:
+        logger.error('SQLite3 Error in metadata.flush: {e}'.format(e=e.args[0]))
+        utils.rollback_db(db)
+        # try them again on the next flush
+        with _lock:
+            _pending.extend(names)
+    finally:
+        utils.close_db(db)
+
+
+def _get_version(item_stats, hero_stats):
+    """ given the item and hero stat tables, return a checksum of what the
+        replies are rendered from.  item stats still as add_item_stat left
+        them (no display, multiplier of 1) render the same whether or not
+        they're in the table, so they're left out; that way flushing newly
+        seen attributes doesn't change the version """
+
+    items = sorted((name, row['display'], row['multiplier'], row['disp_order'])
+                   for name, row in item_stats.iteritems()
+                   if (row['display'], row['multiplier'], row['disp_order']) !=
+                      (None, 1, None))
+    return zlib.crc32(repr((items, sorted(hero_stats.iteritems()))))
+
+def _set_item_id(name):
+    """ give an attribute an id unless it already has one; expects _lock to
+        be held """
+
+    if name not in _item_ids:
+        _item_ids[name] = len(_item_names)
+        _item_names.append(name)
+
+def _load_once():
+    """ load the stat tables unless another thread already has """
+    with _load_lock:
+        if _item_stats is None or _hero_stats is None:
+            load()
@@ -0,0 +1,186 @@
+import os
+import time
+import threading
+import functools
+import contextlib
+import BaseHTTPServer
+import utils
+import logger
+
+config = utils.get_config_params('metrics')
+
+# upper bounds (seconds) of the timing histogram buckets; anything slower
+#   goes in a final overflow bucket
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# counters
+#      key: name
+#      value: count
+_counters = {}
+
+# timings
+#      key: name
+#      value: { 'count', 'total', 'max', 'buckets': [ count per bucket ] }
+_timings = {}
+
+# gauges, read when a snapshot is taken
+#      key: name
+#      value: function returning a number or a dictionary of numbers
+_gauges = {}
+
+_lock = threading.Lock()
+
+# set once the snapshot writer (and http endpoint) are running
+_started = False
+
+def incr(name, count=1):
+    """ add count to the named counter """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + count
+
+def observe(name, seconds):
+    """ add a timing sample (in seconds) to the named histogram """
+
+    with _lock:
+        timing = _timings.get(name)
+        if not timing:
+            timing = { 'count': 0, 'total': 0.0, 'max': 0.0,
+                       'buckets': [0] * (len(BUCKETS) + 1) }
+            _timings[name] = timing
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                timing['buckets'][i] += 1
+                break
+        else:
+            timing['buckets'][-1] += 1
+
+@contextlib.contextmanager
+def timer(name):
+    """ context manager timing its block into the named histogram """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start)
+
+def timed(name):
+    """ decorator timing every call of the function into the named
+        histogram """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def get_timings():
+    """ return a dictionary of { name: { 'count', 'total', 'max' } } for every
+        timing, totals in seconds """
+
+    with _lock:
+        return dict((name, { 'count': t['count'], 'total': t['total'],
+                             'max': t['max'] })
+                    for name, t in _timings.iteritems())
+
+def register_gauge(name, func):
+    """ register a function to be read (returning a number or a dictionary of
+        numbers) whenever a snapshot is taken """
+    with _lock:
+        _gauges[name] = func
+
+def snapshot():
+    """ return every counter, timing and gauge as text, one per line """
+
+    with _lock:
+        counters = dict(_counters)
+        timings = dict((name, dict(t, buckets=list(t['buckets'])))
+                       for name, t in _timings.iteritems())
+        gauges = dict(_gauges)
+
+    lines = ['# d3profilebot metrics at {t}'.format(
+                    t=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()))]
+
+    for name in sorted(counters):
+        lines.append('counter {n} {v}'.format(n=name, v=counters[name]))
+
+    for name in sorted(timings):
+        t = timings[name]
+        buckets = ' '.join('le{b}={c}'.format(b=bound, c=count)
+                           for bound, count in zip(BUCKETS, t['buckets']))
+        lines.append('timing {n} count={c} avg={a:.4f} max={m:.4f} {b} '
+                     'inf={i}'.format(n=name, c=t['count'],
+                                      a=t['total'] / t['count'], m=t['max'],
+                                      b=buckets, i=t['buckets'][-1]))
+
+    for name in sorted(gauges):
+        try:
+            value = gauges[name]()
+        except Exception, e:
+            logger.warn('Failed to read gauge {n}: {e}', n=name, e=e)
+            continue
+        if isinstance(value, dict):
+            for key in sorted(value):
+                lines.append('gauge {n}.{k} {v}'.format(n=name, k=key,
+                                                        v=value[key]))
+        else:
+            lines.append('gauge {n} {v}'.format(n=name, v=value))
+
+    return '\n'.join(lines) + '\n'
+
+def start():
+    """ start writing snapshots to snapshot_file every snapshot_interval
+        seconds and, if http_port is set, serving them on localhost """
+    global _started
+
+    with _lock:
+        if _started:
+            return
+        _started = True
+
+    if config['snapshot_file']:
+        t = threading.Thread(target=_snapshot_writer, name='metrics')
+        t.daemon = True
+        t.start()
+
+    port = config.get_int('http_port')
+    if port:
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _Handler)
+        t = threading.Thread(target=server.serve_forever, name='metrics-http')
+        t.daemon = True
+        t.start()
+        logger.info('Serving metrics on port {p}', p=port)
+
+
+def _snapshot_writer():
+    """ snapshot thread; rewrites snapshot_file every snapshot_interval
+        seconds """
+
+    path = config['snapshot_file']
+    while True:
+        time.sleep(config.get_float('snapshot_interval'))
+        try:
+            # write then rename so readers never see a partial snapshot
+            with open(path + '.tmp', 'w') as f:
+                f.write(snapshot())
+            os.rename(path + '.tmp', path)
+        except Exception, e:
+            logger.error('Failed to write metrics snapshot: {e}', e=e)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ serves the current snapshot as plain text on any path """
+
+    def do_GET(self):
+        body = snapshot()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,189 @@
+import time
+import threading
+import logger
+
+# weight of the newest sample in the item and match rate averages
+RATE_WEIGHT = 0.3
+
+# reddit rate limit state, from the headers of the last response we saw
+#      { 'remaining': requests left, 'reset': seconds until the window resets,
+#        'at': when we saw it }
+_ratelimit = { 'remaining': None, 'reset': None, 'at': None }
+_ratelimit_lock = threading.Lock()
+
+class ListingPoller(object):
+    """ polls one reddit listing (new submissions or comments) of a
+        subreddit, asking only for items newer than the newest one we've
+        seen (the cursor).  when a whole page comes back new, we may have
+        missed some, so it pages back (up to max_limit items) to the cursor.
+        the cursor only moves once the items are committed, so items that
+        weren't handled come back on the next poll.
+
+        it also keeps its own schedule: the interval is picked so about
+        target_items new items arrive between polls, shortened while posts
+        are matching, kept between min_interval and max_interval, and backed
+        off exponentially (error_backoff up to max_backoff) after errors """
+
+    def __init__(self, name, fetch, subreddit, limit, max_limit,
+                 resync_passes, min_interval, max_interval, target_items,
+                 error_backoff, max_backoff):
+        self.name = name
+        self.fetch = fetch
+        self.subreddit = subreddit
+        self.limit = limit
+        self.max_limit = max_limit
+        self.resync_passes = resync_passes
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_items = target_items
+        self.error_backoff = error_backoff
+        self.max_backoff = max_backoff
+
+        # newest item we've seen, None until the first poll
+        self.cursor = None
+        # passes in a row that came back empty
+        self._empty_passes = 0
+
+        # when to poll next, and the interval that got us there
+        self.next_run = 0
+        self.interval = min_interval
+        # averages of new items per second and matches per poll
+        self.item_rate = None
+        self.match_rate = 0.0
+        self._last_poll = None
+        # errors in a row
+        self._errors = 0
+
+    def poll(self, r):
+        """ given a reddit connection, return the items posted since the last
+            committed poll, newest first """
+
+        if not self.cursor:
+            items = self._fetch_page(r)
+        elif self._empty_passes >= self.resync_passes:
+            # reddit returns nothing 'before' a deleted or removed item, so
+            #   every so often check the cursor the long way
+            logger.debug('{n}: resyncing cursor', n=self.name)
+            self._empty_passes = 0
+            items = self._fetch_to_cursor(r, self.limit)
+        else:
+            items = self._fetch_page(r, before=self.cursor.fullname)
+            if len(items) >= self.limit:
+                logger.info('{n}: full page of new items, paging back to '
+                            'the cursor'.format(n=self.name))
+                items = self._fetch_to_cursor(r, self.max_limit)
+        return items
+
+    def commit(self, items):
+        """ given the items from the last poll, once they have all been
+            handled, move the cursor past them """
+
+        if items:
+            self.cursor = items[0]
+            self._empty_passes = 0
+        else:
+            self._empty_passes += 1
+
+    def schedule(self, new_items, matches):
+        """ given the number of new items and matches from the last poll,
+            work out when to poll next """
+
+        now = time.time()
+        if self._last_poll:
+            rate = new_items / max(now - self._last_poll, 1e-3)
+            if self.item_rate is None:
+                self.item_rate = rate
+            else:
+                self.item_rate = RATE_WEIGHT * rate + \
+                                 (1 - RATE_WEIGHT) * self.item_rate
+        self.match_rate = RATE_WEIGHT * matches + \
+                          (1 - RATE_WEIGHT) * self.match_rate
+        self._last_poll = now
+        self._errors = 0
+
+        if self.item_rate is None:
+            # no rate yet, poll again soon to get one
+            interval = self.min_interval
+        elif self.item_rate:
+            interval = self.target_items / self.item_rate
+        else:
+            interval = self.max_interval
+        # a thread that's matching is likely to get more links soon
+        interval /= 1 + self.match_rate
+
+        self.interval = min(max(interval, self.min_interval),
+                            self.max_interval)
+        self.next_run = now + self.interval
+        logger.debug('{n}: {i} new, {m} matched, next poll in {s:.1f}s',
+                     n=self.name, i=new_items, m=matches, s=self.interval)
+
+    def failed(self):
+        """ back off after an error polling the listing; returns the number of
+            seconds until the next try """
+
+        self._errors += 1
+        delay = get_backoff(self._errors, self.error_backoff, self.max_backoff)
+        self.next_run = time.time() + delay
+        return delay
+
+    def _fetch_page(self, r, before=None):
+        """ fetch a single page of up to limit items, optionally only those
+            newer than the 'before' fullname """
+
+        params = { 'limit': self.limit }
+        if before:
+            params['before'] = before
+        # limit=0 makes praw fetch just the one page
+        return list(self.fetch(r, self.subreddit, limit=0, params=params))
+
+    def _fetch_to_cursor(self, r, limit):
+        """ page back through the listing until we reach the cursor or have
+            fetched limit items; returns the items newer than the cursor """
+
+        items = []
+        for item in self.fetch(r, self.subreddit, limit=limit,
+                               place_holder=self.cursor.id):
+            if item.id == self.cursor.id:
+                break
+            items.append(item)
+        return items
+
+
+def get_backoff(errors, error_backoff, max_backoff):
+    """ given the number of errors in a row, return how many seconds to back
+        off: error_backoff after the first, doubling up to max_backoff """
+    return min(error_backoff * 2 ** (errors - 1), max_backoff)
+
+def fetch_submissions(r, subreddit, **kwargs):
+    """ given a reddit connection and subreddit name, return the newest
+        submissions; kwargs are passed through to praw """
+    return r.get_subreddit(subreddit).get_new(**kwargs)
+
+def fetch_comments(r, subreddit, **kwargs):
+    """ given a reddit connection and subreddit name, return the newest
+        comments; kwargs are passed through to praw """
+    return r.get_comments(subreddit, **kwargs)
+
+def record_ratelimit(response, *args, **kwargs):
+    """ requests response hook; remembers reddit's rate limit headers """
+
+    remaining = response.headers.get('x-ratelimit-remaining')
+    reset = response.headers.get('x-ratelimit-reset')
+    if remaining is None or reset is None:
+        return
+    with _ratelimit_lock:
+        _ratelimit['remaining'] = float(remaining)
+        _ratelimit['reset'] = float(reset)
+        _ratelimit['at'] = time.time()
+
+def ratelimit_delay(reserve):
+    """ given the number of requests to hold back for replies and karma
+        checks, return how long to wait before polling (0 if we can poll now)
+        based on the last rate limit headers we saw """
+
+    with _ratelimit_lock:
+        if _ratelimit['remaining'] is None:
+            return 0
+        if _ratelimit['remaining'] > reserve:
+            return 0
+        return max(_ratelimit['at'] + _ratelimit['reset'] - time.time(), 0)
@@ -1,116 +1,274 @@
 import time
-import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
 import lookup
+import metadata
+import records
 import utils
 import logger
+import metrics
 
 config = utils.get_config_params('profiler')
 
-def get_gear(hero_data, region='us'):
+# attributes whose max is the damage range (min + the Delta attribute's max)
+_RANGE_ATTRS = ('Damage_Weapon_Min', '_Weapon_Bonus_Min')
+_RANGE_EXACT = 'Damage_Min'
+# the bleed chance attribute's max is the bleed damage
+_BLEED_CHANCE = 'Weapon_On_Hit_Percent_Bleed_Proc_Chance'
+_BLEED_DAMAGE = 'Weapon_On_Hit_Percent_Bleed_Proc_Damage'
+
+# fetch_workers threads shared by every _fetch_all call; started the first
+#   time a fetch needs them and kept for the life of the process
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_career(profile, region='us', max_heroes=None):
+    """ given a profile (battletag), profile every hero on it (or the first
+        max_heroes, highest level first) in one pass: the career profile is
+        fetched once, then every hero, then every item the heroes wear, with
+        items shared between heroes only fetched once.  returns a dictionary
+        of { 'profile': profile, 'battle_tag': battletag,
+             'heroes': [ get_profile, ... ] } or None if the profile couldn't
+        be loaded; heroes that fail to load are left out """
+
+    career = lookup.profile_lookup(profile, region=region)
+    if not career:
+        return None
+
+    # a profile without heroes has no heroes field at all
+    hero_ids = [hero['id'] for hero in career.get('heroes', [])]
+    if max_heroes:
+        hero_ids = hero_ids[:max_heroes]
+    heroes = _fetch_all(lambda hero_id: lookup.hero_lookup(profile,
+                                                           hero_id=hero_id,
+                                                           region=region),
+                        hero_ids)
+    for hero_id, hero_data in zip(hero_ids, heroes):
+        if not hero_data:
+            logger.warn('Unable to load hero {h} of {p}'.format(h=hero_id,
+                                                                p=profile))
+    heroes = [hero_data for hero_data in heroes if hero_data]
+
+    items, base_items = fetch_gear(heroes, region=region)
+
+    profiles = []
+    for hero_data in heroes:
+        hero_profile = get_profile(hero_data, region=region, items=items,
+                                   base_items=base_items)
+        if hero_profile:
+            profiles.append(hero_profile)
+
+    return {
+                'profile':      profile,
+                'battle_tag':   career.get('battleTag', profile),
+                'heroes':       profiles
+           }
+
+
+def fetch_gear(heroes, region='us'):
+    """ given a list of hero data, fetch every item (and base item) the
+        heroes wear, each once; returns (items, base_items) to pass on to
+        get_profile or get_gear, so they don't fetch anything themselves """
+
+    item_urls = [hero_data['items'][slot]['tooltipParams']
+                 for hero_data in heroes for slot in hero_data['items']]
+    items = _fetch_items(item_urls, region)
+    base_items = _fetch_base_items([item_data for item_data in items.values()
+                                    if item_data and _has_item_url(item_data)],
+                                   region)
+    return items, base_items
+
+
+def get_profile(hero_data, region='us', items=None, base_items=None):
+    """ given a dictionary of hero data, return everything the formatter
+        needs for a full profile as a dictionary of:
+        { 'intro': get_intro_info, 'gear': get_gear, 'stats': get_stats,
+          'gear_stats': get_stats_from_gear, 'skills': get_skills }
+        or None if the gear couldn't be loaded.  items and base_items are
+        passed on to get_gear """
+
+    gear = get_gear(hero_data, region=region, items=items,
+                    base_items=base_items)
+    if gear is None:
+        return None
+
+    return {
+                'intro':        get_intro_info(hero_data, region=region),
+                'gear':         gear,
+                'stats':        get_stats(hero_data, region=region),
+                'gear_stats':   get_stats_from_gear(gear, region=region),
+                'skills':       get_skills(hero_data, region=region)
+           }
+
+
+@metrics.timed('profiler.get_gear')
+def get_gear(hero_data, region='us', items=None, base_items=None):
     """ given a dictionary of hero data, get the gear and return it in a
-        dictionary of { item_slot: { item_info } } use region to get proper
-        urls """
+        dictionary of { item_slot: records.Item } use region to get proper
+        urls.  items ({ tooltipParams: item data }) and base_items
+        ({ item id: base item data }) are used instead of fetching the ones
+        already loaded (see get_career) """
 
     gear = {}
 
-    try:
-        # open a db connection
-        db = sqlite3.connect(config['database'])
-        db_cur = db.cursor()
-        table = config['item_table']
-
-        for slot, item in hero_data['items'].iteritems():
-            item_url = item['tooltipParams']
-            item_data = lookup.item_lookup(item_url, region=region)
-
-            if not item_data:
-                logger.error('Unable to load item {i}'.format(i=item_url))
-                utils.close_db(db)
-                return None
-
-            gear[slot] = {
-                            'name': item_data['name'],
-                            'type': item_data['typeName']
-                         }
-
-            # get the url for legendaries/set items
-            if 'Legendary' in gear[slot]['type'] or 'Set' in gear[slot]['type']:
-                gear[slot]['url'] = _get_item_url(item_data, region)
-            else:
-                gear[slot]['url'] = None
-
-            # get any passive effects text
-            gear[slot]['passives'] = []
-            for passive in item_data['attributes']['passive']:
-                # replace all whitespace (newlines included) with a space
-                gear[slot]['passives'].append(' '.join(passive['text'].split()))
-
-            # get raw attributes (used for custom display + stat calculation)
-            gear[slot]['stats'] = []
-            for attr in item_data['attributesRaw']:
-                # check if attribute name is in database; if not, add it and log
-                query = 'SELECT * FROM {t} WHERE name=\'{a}\''
-                db_cur.execute(query.format(t=table,a=attr))
-
-                row = db_cur.fetchone()
-                if not row:
-                    logger.info('Adding {a} to {t}'.format(a=attr, t=table))
-                    query = 'INSERT INTO {t}(name,multiplier) VALUES(\'{a}\',1)'
-                    db_cur.execute(query.format(t=table,a=attr))
-
-                # multiply values by the multiplier
-                query = 'SELECT multiplier FROM {t} WHERE name=\'{a}\''
-                db_cur.execute(query.format(t=table,a=attr))
-                row = db_cur.fetchone()
-                a_min = item_data['attributesRaw'][attr]['min'] * row[0]
-                a_max = item_data['attributesRaw'][attr]['max'] * row[0]
-
-                # if this is a damage_min, change the max value to be min+delta 
-                dmg = ['Damage_Weapon_Min', '_Weapon_Bonus_Min', 'Damage_Min']
-                if dmg[0] in attr or dmg[1] in attr or dmg[2] == attr:
-                    attr_d = attr.replace('Min','Delta')
-                    a_max = item_data['attributesRaw'][attr_d]['max'] * row[0]
-                    a_max += a_min
-                # if this is a bleed chance, set max value to be the damage
-                elif 'Weapon_On_Hit_Percent_Bleed_Proc_Chance' == attr:
-                    dmg = 'Weapon_On_Hit_Percent_Bleed_Proc_Damage'
-                    db_cur.execute(query.format(t=table,a=dmg))
-                    row = db_cur.fetchone()
-                    if dmg in item_data['attributesRaw']:
-                        a_max = item_data['attributesRaw'][dmg]['min'] * row[0]
-                    else:
-                        a_max = 0
-
-                gear[slot]['stats'].append( {
-                                                'name': attr,
-                                                'min': a_min,
-                                                'max': a_max
-                                            } )
-
-            # get gem info - note we only keep MAX value; gems don't have ranges
-            if item_data['gems']:
-                gear[slot]['gems'] = []
-                query = 'SELECT multiplier FROM {t} WHERE name=\'{a}\''
-                for gem in item_data['gems']:
-                    for attr in gem['attributesRaw']:
-                        db_cur.execute(query.format(t=table,a=attr))
-                        row = db_cur.fetchone()
-                        value = gem['attributesRaw'][attr]['max'] * row[0]
-                        gear[slot]['gems'].append({ 'attr': attr, 'val': value})
-            db.commit()
-    except sqlite3.Error, e:
-        logger.error('SQLite3 Error in get_gear: {e}'.format(e=e.args[0]))
-        utils.rollback_db(db)
-    finally:
-        utils.close_db(db)
+    # fetch every slot first (in parallel if fetch_workers > 1); one failed
+    #   slot aborts the whole fetch
+    slots = hero_data['items'].keys()
+    item_urls = [hero_data['items'][slot]['tooltipParams'] for slot in slots]
+    items = _fetch_items(item_urls, region, items)
+
+    for item_url in item_urls:
+        if not items[item_url]:
+            logger.error('Unable to load item {i}'.format(i=item_url))
+            return None
+    items = dict((slot, items[url]) for slot, url in zip(slots, item_urls))
+
+    # then fetch the base items for legendaries/set items, again in parallel
+    base_slots = [slot for slot in slots if _has_item_url(items[slot])]
+    base_items = _fetch_base_items([items[slot] for slot in base_slots],
+                                   region, base_items)
+    base_items = dict((slot, base_items[items[slot]['id']])
+                      for slot in base_slots)
+
+    for slot in slots:
+        item_data = items[slot]
+        item = records.Item(item_data['name'], item_data['typeName'])
+
+        # get the url for legendaries/set items
+        if base_items.get(slot):
+            item.url = _get_item_url(item_data, base_items[slot], region)
+
+        # get any passive effects text
+        for passive in item_data['attributes']['passive']:
+            # replace all whitespace (newlines included) with a space
+            item.passives.append(' '.join(passive['text'].split()))
+
+        # raw attributes (used for custom display + stat calculation)
+        item.stats = _get_item_stats(item_data['attributesRaw'])
+
+        # get gem info - note we only keep MAX value; gems don't have ranges
+        for gem in item_data['gems']:
+            for attr in gem['attributesRaw']:
+                multiplier = _get_multiplier(attr)
+                value = gem['attributesRaw'][attr]['max'] * multiplier
+                item.gems.append(records.Gem(metadata.get_item_stat_id(attr),
+                                             value))
+
+        gear[slot] = item
+
+    # write any attributes we saw for the first time back to the database
+    metadata.flush()
 
     return gear
 
 
-def _get_item_url(item_data, region):
-    """ given a dictionary of item data, return the item url """
-    item_url = 'item/{id}'.format(id=item_data['id'])
-    base_data = lookup.item_lookup(item_url, region=region)
+def _get_item_stats(raw):
+    """ given an item's raw attributes, return them as a list of records.Stat
+        with the multipliers applied, damage mins given a max of min + delta
+        and bleed chances given a max of the bleed damage """
+
+    stats = []
+    for attr in raw:
+        # multiply values by the multiplier
+        multiplier = _get_multiplier(attr)
+        a_min = raw[attr]['min'] * multiplier
+        a_max = raw[attr]['max'] * multiplier
+
+        # if this is a damage_min, change the max value to be min+delta
+        if any(dmg in attr for dmg in _RANGE_ATTRS) or attr == _RANGE_EXACT:
+            attr_d = attr.replace('Min', 'Delta')
+            if attr_d in raw:
+                a_max = raw[attr_d]['max'] * multiplier + a_min
+        # if this is a bleed chance, set max value to be the damage
+        elif attr == _BLEED_CHANCE:
+            if _BLEED_DAMAGE in raw:
+                a_max = raw[_BLEED_DAMAGE]['min'] * \
+                        _get_multiplier(_BLEED_DAMAGE)
+            else:
+                a_max = 0
+
+        stats.append(records.Stat(metadata.get_item_stat_id(attr), a_min,
+                                  a_max))
+    return stats
+
+
+def _get_multiplier(attr):
+    """ given an attribute name, return its multiplier; attributes we haven't
+        seen before are added to the metadata with a multiplier of 1 """
+    row = metadata.get_item_stat(attr)
+    if not row:
+        row = metadata.add_item_stat(attr)
+    return row['multiplier']
+
+
+def _fetch_all(fetch, args):
+    """ call fetch for every value in args and return the results in the same
+        order; uses the shared pool of fetch_workers threads (1 or less is
+        serial).  fetch runs on the pool, so it must not call _fetch_all """
+
+    if min(config.get_int('fetch_workers', 1), len(args)) <= 1:
+        return [fetch(arg) for arg in args]
+    return _get_pool().map(fetch, args)
+
+def _get_pool():
+    """ return the shared fetch pool, starting it the first time """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(config.get_int('fetch_workers'))
+    return _pool
+
+
+def _fetch_items(item_urls, region, items=None):
+    """ given a list of item urls (tooltipParams), return a dictionary of
+        { item url: item data or None if it failed }, fetching each url once
+        and only those not already in items """
+
+    items = dict(items or {})
+    missing = _unique(url for url in item_urls if url not in items)
+    fetched = _fetch_all(lambda url: lookup.item_lookup(url, region=region),
+                         missing)
+    items.update(zip(missing, fetched))
+    return items
+
+
+def _fetch_base_items(items, region, base_items=None):
+    """ given a list of item data for legendaries/set items, return a
+        dictionary of { item id: base item data }, fetching each base item
+        once and only those not already in base_items """
+
+    base_items = dict(base_items or {})
+    missing = _unique(item_data['id'] for item_data in items
+                      if item_data['id'] not in base_items)
+    fetched = _fetch_all(lambda item_id: lookup.base_item_lookup(item_id,
+                                                                 region=region),
+                         missing)
+    base_items.update(zip(missing, fetched))
+    return base_items
+
+
+def _unique(values):
+    """ given an iterable, return a list of its values without repeats, in
+        the order first seen """
+    seen = set()
+    unique = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique.append(value)
+    return unique
+
+
+def _has_item_url(item_data):
+    """ given a dictionary of item data, return true if the item links to its
+        base item page (legendaries and set items) """
+    return 'Legendary' in item_data['typeName'] or 'Set' in item_data['typeName']
+
+
+def _get_item_url(item_data, base_data, region):
+    """ given a dictionary of item data and its base item data, return the
+        item url """
     base = config['base_url'].format(region=region)
     item = base_data['tooltipParams'].replace('item/','').replace('recipe/','')
 
@@ -125,54 +283,53 @@ def _get_item_url(item_data, region):
     return full_url
 
 
+@metrics.timed('profiler.get_stats')
 def get_stats(hero_data, region='us'):
     """ given a dictionary of hero data, return a dictionary of {'stat': value}
         note that the stat name will be in API form, not displayable form """
 
     stats = {}
 
-    try:
-        # open a db connection
-        db = sqlite3.connect(config['database'])
-        db.row_factory = sqlite3.Row
-        db_cur = db.cursor()
-        table = config['stats_table']
-        query = 'SELECT * FROM {t} WHERE name=\'{s}\''
+    for stat in hero_data['stats']:
+        row = metadata.get_hero_stat(stat)
+        if not row:
+            logger.warn('Unknown hero stat {s}, skipping'.format(s=stat))
+            continue
+        s = hero_data['stats'][stat] * row['multiplier']
+        stats[stat] = s
 
-        for stat in hero_data['stats']:
-            db_cur.execute(query.format(t=table,s=stat))
-            row = db_cur.fetchone()
-            s = hero_data['stats'][stat] * row['multiplier']
-            stats[stat] = s
-
-        return stats
-    except sqlite3.Error, e:
-        logger.error('SQLite3 Error in get_stats: {e}'.format(e=e.args[0]))
-        utils.rollback_db(db)
-    finally:
-        utils.close_db(db)
+    return stats
 
 
+@metrics.timed('profiler.get_stats_from_gear')
 def get_stats_from_gear(gear, region='us'):
     """ given a gear dictionary (created by get_gear), return the stats listed
         in the config file """
 
-    g_stats = dict.fromkeys(config['gear_stats'].split(','), 0)
+    names = config.get_list('gear_stats')
+    g_stats = dict.fromkeys(names, 0)
+
+    # total every attribute in one pass over the slots, so any number of
+    #   gear stats are just lookups
+    totals = {}
+    for item in gear.itervalues():
+        for stat in item.stats:
+            totals[stat.id] = totals.get(stat.id, 0) + stat.min
 
-    for slot in gear:
-        for stat in gear[slot]['stats']:
-            if stat['name'] in g_stats:
-                val = stat['min']
-                g_stats[stat['name']] += val
+    for name in names:
+        stat_id = metadata.get_item_stat_id(name)
+        if stat_id in totals:
+            g_stats[name] = totals[stat_id]
 
     return g_stats
 
 
 
+@metrics.timed('profiler.get_skills')
 def get_skills(hero_data, region='us'):
     """ given a dictionary of hero data, return a dictionary of:
-        { 'active': [{ 'name': skill name, 'rune': rune name, 'url': url },...],
-          'passive': [{ 'name': s1, 'url': url }, ... ] } """
+        { 'active': [ records.Skill, ... ], 'passive': [ records.Skill, ... ] }
+        passives have no rune, and empty skill slots have no name or url """
 
     skills = { 'active': [], 'passive': [] }
     for ability in hero_data['skills']['active']:
@@ -184,17 +341,18 @@ def get_skills(hero_data, region='us'):
             url = _get_skill_url(ability, 'active', region)
             if 'rune' in ability.keys():
                 rune = ability['rune']['name']
-        skills['active'].append({'name': name, 'rune': rune, 'url': url})
+        skills['active'].append(records.Skill(name, rune=rune, url=url))
     for ability in hero_data['skills']['passive']:
         name = None
         url = None
         if ability:
             name = ability['skill']['name']
             url = _get_skill_url(ability, 'passive', region)
-        skills['passive'].append({'name': name, 'url': url})
+        skills['passive'].append(records.Skill(name, url=url))
 
     return skills
 
+@metrics.timed('profiler.get_intro_info')
 def get_intro_info(hero_data, region='us'):
     """ given a dictionary of hero data, return a dictionary of:
         { 'name': name, 'url': url, 'class': class, 'hardcore': hardcore,
@@ -0,0 +1,87 @@
+""" compact records for the gear and skills the profiler hands the formatter
+
+    these use __slots__ so they carry no per-object dictionary, and item stats
+    are kept as integer ids from the metadata tables rather than names """
+import metadata
+
+class Item(object):
+    """ one equipped item: name, type, url (None unless it links to its base
+        item), passives (list of text), stats (list of Stat) and gems (list
+        of Gem) """
+
+    __slots__ = ('name', 'type', 'url', 'passives', 'stats', 'gems')
+
+    def __init__(self, name, i_type, url=None, passives=(), stats=(), gems=()):
+        self.name = name
+        self.type = i_type
+        self.url = url
+        self.passives = list(passives)
+        self.stats = list(stats)
+        self.gems = list(gems)
+
+    def to_dict(self):
+        """ return the item as a dictionary, with its stats and gems too """
+        return { 'name': self.name, 'type': self.type, 'url': self.url,
+                 'passives': self.passives,
+                 'stats': [stat.to_dict() for stat in self.stats],
+                 'gems': [gem.to_dict() for gem in self.gems] }
+
+class Stat(object):
+    """ one item attribute, with its multiplier (and damage range) applied """
+
+    __slots__ = ('id', 'min', 'max')
+
+    def __init__(self, stat_id, a_min, a_max):
+        self.id = stat_id
+        self.min = a_min
+        self.max = a_max
+
+    @property
+    def name(self):
+        """ the attribute name (API form) """
+        return metadata.get_item_stat_name(self.id)
+
+    def to_dict(self):
+        """ return the stat as a dictionary of { 'name', 'min', 'max' } """
+        return { 'name': self.name, 'min': self.min, 'max': self.max }
+
+class Gem(object):
+    """ one attribute of a socketed gem; gems don't have ranges so there is
+        just the (max) value """
+
+    __slots__ = ('id', 'val')
+
+    def __init__(self, stat_id, val):
+        self.id = stat_id
+        self.val = val
+
+    @property
+    def attr(self):
+        """ the attribute name (API form) """
+        return metadata.get_item_stat_name(self.id)
+
+    def to_dict(self):
+        """ return the gem as a dictionary of { 'attr', 'val' } """
+        return { 'attr': self.attr, 'val': self.val }
+
+class Skill(object):
+    """ an active or passive skill: name, rune (None for passives or an
+        empty skill slot) and url """
+
+    __slots__ = ('name', 'rune', 'url')
+
+    def __init__(self, name, rune=None, url=None):
+        self.name = name
+        self.rune = rune
+        self.url = url
+
+    def to_dict(self):
+        """ return the skill as a dictionary of { 'name', 'rune', 'url' } """
+        return { 'name': self.name, 'rune': self.rune, 'url': self.url }
+
+
+def to_json(obj):
+    """ json.dumps default hook: converts records to dictionaries """
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError('{o!r} is not JSON serializable'.format(o=obj))
@@ -0,0 +1,219 @@
+import time
+import sqlite3
+import threading
+import utils
+import logger
+import metrics
+
+config = utils.get_config_params('state')
+
+# writes waiting for the next flush, in order
+#      list of (query, params)
+_pending = []
+_pending_lock = threading.Lock()
+_flush_lock = threading.Lock()
+
+# when we last flushed
+_last_flush = 0
+
+# set once the state tables have been created
+_initialized = False
+
+# set once the flusher thread is running
+_started = False
+
+def load():
+    """ load the saved bot state; returns a dictionary of:
+        { 'searched': [ (post_id, created), ... ],
+          'replied': { submission_id: [ hero_info, ... ] },
+          'our_posts': { post_id: { 's_id', 'timestamp' } },
+          'failed': { post_id: attempts } } """
+
+    state = { 'searched': [], 'replied': {}, 'our_posts': {}, 'failed': {} }
+    db = None
+    try:
+        db = _connect()
+        db_cur = db.cursor()
+
+        query = 'SELECT post_id, created FROM {t}'
+        db_cur.execute(query.format(t=_get_table('searched')))
+        state['searched'] = db_cur.fetchall()
+
+        query = 'SELECT s_id, region, profile, hero_id FROM {t}'
+        db_cur.execute(query.format(t=_get_table('replied')))
+        for s_id, region, profile, hero_id in db_cur.fetchall():
+            hero_info = { 'profile': profile, 'hero_id': hero_id,
+                          'region': region }
+            state['replied'].setdefault(s_id, []).append(hero_info)
+
+        query = 'SELECT post_id, s_id, timestamp FROM {t}'
+        db_cur.execute(query.format(t=_get_table('our_posts')))
+        for post_id, s_id, timestamp in db_cur.fetchall():
+            state['our_posts'][post_id] = { 's_id': s_id,
+                                            'timestamp': timestamp }
+
+        query = 'SELECT post_id, attempts FROM {t}'
+        db_cur.execute(query.format(t=_get_table('failed')))
+        state['failed'] = dict(db_cur.fetchall())
+        metrics.incr('sqlite.queries', 4)
+    except sqlite3.Error, e:
+        logger.error('SQLite3 Error in state.load: {e}'.format(e=e.args[0]))
+    finally:
+        utils.close_db(db)
+
+    return state
+
+def save_searched(post_id, created):
+    """ save a searched post id and the time the post was made """
+    query = 'INSERT OR REPLACE INTO {t}(post_id,created) VALUES(?,?)'
+    _queue(query.format(t=_get_table('searched')), (post_id, created))
+
+def forget_searched(post_id):
+    """ remove a searched post id (so it is searched again) """
+    query = 'DELETE FROM {t} WHERE post_id=?'
+    _queue(query.format(t=_get_table('searched')), (post_id,))
+
+def expire_searched(cutoff):
+    """ remove searched posts made before the cutoff timestamp """
+    query = 'DELETE FROM {t} WHERE created<?'
+    _queue(query.format(t=_get_table('searched')), (cutoff,))
+
+def save_replied(s_id, hero_info, timestamp):
+    """ save a hero we've replied with in the given submission and the time
+        of our reply """
+    query = 'INSERT OR IGNORE INTO {t}(s_id,region,profile,hero_id,' \
+            'timestamp) VALUES(?,?,?,?,?)'
+    _queue(query.format(t=_get_table('replied')),
+           (s_id, hero_info['region'], hero_info['profile'],
+            hero_info['hero_id'], timestamp))
+
+def expire_replied(cutoff):
+    """ remove heroes we replied with before the cutoff timestamp """
+    query = 'DELETE FROM {t} WHERE timestamp<?'
+    _queue(query.format(t=_get_table('replied')), (cutoff,))
+
+def save_our_post(post_id, s_id, timestamp):
+    """ save one of our own posts """
+    query = 'INSERT OR REPLACE INTO {t}(post_id,s_id,timestamp) VALUES(?,?,?)'
+    _queue(query.format(t=_get_table('our_posts')), (post_id, s_id, timestamp))
+
+def forget_our_post(post_id):
+    """ remove one of our own posts (deleted or too old to track) """
+    query = 'DELETE FROM {t} WHERE post_id=?'
+    _queue(query.format(t=_get_table('our_posts')), (post_id,))
+
+def save_failed(post_id, attempts, created):
+    """ save the number of failed attempts for a post and the time the post
+        was made """
+    query = 'INSERT OR REPLACE INTO {t}(post_id,attempts,created) ' \
+            'VALUES(?,?,?)'
+    _queue(query.format(t=_get_table('failed')), (post_id, attempts, created))
+
+def expire_failed(cutoff):
+    """ remove failed posts made before the cutoff timestamp """
+    query = 'DELETE FROM {t} WHERE created<?'
+    _queue(query.format(t=_get_table('failed')), (cutoff,))
+
+def start():
+    """ start the flusher thread, which writes pending changes every
+        flush_interval seconds whatever thread queued them """
+    global _started
+
+    with _pending_lock:
+        if _started:
+            return
+        _started = True
+
+    t = threading.Thread(target=_flusher, name='state')
+    t.daemon = True
+    t.start()
+
+def flush_if_due():
+    """ flush pending writes if flush_interval seconds have passed since the
+        last flush or flush_size writes are waiting """
+
+    with _pending_lock:
+        count = len(_pending)
+    if not count:
+        return
+    if count >= config.get_int('flush_size') or \
+            time.time() - _last_flush >= config.get_float('flush_interval'):
+        flush()
+
+def flush():
+    """ write all pending state changes in one transaction; flushes from
+        different threads take turns so the writes stay in order """
+    global _last_flush
+
+    with _flush_lock:
+        with _pending_lock:
+            writes = list(_pending)
+            del _pending[:]
+        _last_flush = time.time()
+        if not writes:
+            return
+
+        db = None
+        try:
+            db = _connect()
+            db_cur = db.cursor()
+            for query, params in writes:
+                db_cur.execute(query, params)
+            db.commit()
+            metrics.incr('sqlite.queries', len(writes))
+            logger.debug('Saved {n} state changes', n=len(writes))
+        except sqlite3.Error, e:
+            logger.error('SQLite3 Error in state.flush: {e}'.format(
+                                                                e=e.args[0]))
+            utils.rollback_db(db)
+            # keep them for the next flush
+            with _pending_lock:
+                _pending[:0] = writes
+        finally:
+            utils.close_db(db)
+
+
+def _flusher():
+    """ flusher thread; runs flush every flush_interval seconds """
+
+    while True:
+        time.sleep(config.get_float('flush_interval'))
+        try:
+            flush()
+        except Exception, e:
+            logger.error('Error in state flusher: {e}'.format(e=e))
+
+
+def _queue(query, params):
+    """ queue a write for the next flush """
+    with _pending_lock:
+        _pending.append((query, params))
+
+def _connect():
+    """ open a connection to the state database, creating the state tables
+        the first time through """
+
+    global _initialized
+
+    db = sqlite3.connect(config['database'], timeout=30)
+    if not _initialized:
+        db.execute('CREATE TABLE IF NOT EXISTS {t}(post_id TEXT PRIMARY KEY, '
+                   'created REAL)'.format(t=_get_table('searched')))
+        db.execute('CREATE TABLE IF NOT EXISTS {t}(s_id TEXT, region TEXT, '
+                   'profile TEXT, hero_id TEXT, timestamp REAL, '
+                   'PRIMARY KEY(s_id, region, profile, hero_id))'.format(
+                                                t=_get_table('replied')))
+        db.execute('CREATE TABLE IF NOT EXISTS {t}(post_id TEXT PRIMARY KEY, '
+                   's_id TEXT, timestamp REAL)'.format(
+                                                t=_get_table('our_posts')))
+        db.execute('CREATE TABLE IF NOT EXISTS {t}(post_id TEXT PRIMARY KEY, '
+                   'attempts INTEGER, created REAL)'.format(
+                                                t=_get_table('failed')))
+        db.commit()
+        _initialized = True
+    return db
+
+def _get_table(name):
+    """ given a state name (searched, replied, our_posts, failed), return its
+        table name """
+    return '{p}{n}'.format(p=config['table_prefix'], n=name)
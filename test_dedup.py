@@ -0,0 +1,47 @@
+""" tests for dedup; run from the repository root with
+        python -m unittest test_dedup """
+import unittest
+import dedup
+
+class DedupStoreTest(unittest.TestCase):
+
+    def test_add_contains_discard(self):
+        store = dedup.DedupStore(7200, bucket_size=3600)
+        store.add('abc', 1000)
+        self.assertTrue(store.contains('abc', 1000))
+        # a post is only looked for in the bucket of its own timestamp
+        self.assertFalse(store.contains('abc', 5000))
+        store.discard('abc', 1000)
+        self.assertFalse(store.contains('abc', 1000))
+        self.assertEqual(len(store), 0)
+
+    def test_expire_drops_old_buckets(self):
+        store = dedup.DedupStore(7200, bucket_size=3600)
+        store.add('old', 100)
+        store.add('older', 200)
+        store.add('new', 7300)
+        # buckets ending more than max_age before now are dropped whole
+        self.assertEqual(store.expire(now=10900), 2)
+        self.assertFalse(store.contains('old', 100))
+        self.assertTrue(store.contains('new', 7300))
+        self.assertEqual(store.expire(now=10900), 0)
+        self.assertEqual(len(store), 1)
+
+    def test_expire_keeps_bucket_of_cutoff(self):
+        store = dedup.DedupStore(3600, bucket_size=3600)
+        store.add('abc', 3700)
+        self.assertEqual(store.expire(now=7300), 0)
+        self.assertTrue(store.contains('abc', 3700))
+
+    def test_compact_ids(self):
+        store = dedup.DedupStore(3600, compact=True)
+        store.add('2xyz9q', 100)
+        self.assertTrue(store.contains('2xyz9q', 100))
+        self.assertFalse(store.contains('2xyz9r', 100))
+        self.assertEqual(store._buckets[0], set([int('2xyz9q', 36)]))
+        store.discard('2xyz9q', 100)
+        self.assertEqual(len(store), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
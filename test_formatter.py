@@ -0,0 +1,35 @@
+""" tests for formatter; run from the repository root with
+        python -m unittest test_formatter """
+import unittest
+import formatter
+import records
+
+class FormatSkillsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.skills = {
+            'active': [records.Skill(u'Vault', rune=u'Tumble',
+                                     url=u'http://example/vault'),
+                       records.Skill(None)],
+            'passive': [records.Skill(u'Archery', url=u'http://example/arch'),
+                        records.Skill(None)] }
+
+    def test_empty_slots(self):
+        text = formatter.format_skills(self.skills)
+        self.assertIn(u'> |[Vault](http://example/vault)|None|', text)
+        self.assertIn(u'> |Tumble|None|', text)
+        self.assertIn(u'> |[Archery](http://example/arch)|None|', text)
+
+    def test_profile_with_empty_slots(self):
+        profile = { 'intro': { 'name': u'Hero', 'url': None, 'level': 70,
+                               'paragon_level': 10, 'hardcore': u'',
+                               'class': u'Demon Hunter' },
+                    'gear': {}, 'stats': {}, 'gear_stats': {},
+                    'skills': self.skills }
+        text = formatter.format_profile(profile)
+        self.assertTrue(text.startswith(u'### **Text Profile for Hero**'))
+        self.assertIn(u'|None|', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
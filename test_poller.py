@@ -0,0 +1,121 @@
+""" tests for poller; run from the repository root with
+        python -m unittest test_poller """
+import unittest
+import poller
+
+class Item(object):
+    """ a listing item with just what the poller reads """
+
+    def __init__(self, item_id):
+        self.id = item_id
+        self.fullname = 't3_{i}'.format(i=item_id)
+
+class Listing(object):
+    """ a fake reddit listing, newest first, with a fetch that answers the
+        way praw does for the poller's two kinds of call """
+
+    def __init__(self):
+        self.items = []
+        self.calls = []
+        # ids reddit won't page 'before' any more (deleted or removed)
+        self.removed = set()
+
+    def post(self, *ids):
+        for item_id in ids:
+            self.items.insert(0, Item(item_id))
+
+    def fetch(self, r, subreddit, limit=None, params=None, place_holder=None):
+        if params is not None:
+            self.calls.append(('page', params.get('before')))
+            items = self.items
+            before = params.get('before')
+            if before:
+                ids = [item.fullname for item in self.items]
+                if before in self.removed or before not in ids:
+                    return []
+                # the page of items just newer than 'before'
+                items = self.items[:ids.index(before)][-params['limit']:]
+            return items[:params['limit']]
+
+        self.calls.append(('to_cursor', place_holder))
+        return self._to_cursor(limit, place_holder)
+
+    def _to_cursor(self, limit, place_holder):
+        for item in self.items[:limit]:
+            yield item
+            if item.id == place_holder:
+                return
+
+class ListingPollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listing = Listing()
+        self.poller = poller.ListingPoller('test', self.listing.fetch, 'test',
+                                           limit=3, max_limit=10,
+                                           resync_passes=2, min_interval=5,
+                                           max_interval=120, target_items=10,
+                                           error_backoff=30, max_backoff=600)
+
+    def poll(self):
+        items = self.poller.poll(None)
+        self.poller.commit(items)
+        return [item.id for item in items]
+
+    def test_first_poll(self):
+        self.listing.post('a', 'b', 'c', 'd', 'e')
+        self.assertEqual(self.poll(), ['e', 'd', 'c'])
+        self.assertEqual(self.listing.calls, [('page', None)])
+        self.assertEqual(self.poller.cursor.id, 'e')
+
+    def test_incremental_poll(self):
+        self.listing.post('a', 'b')
+        self.poll()
+        self.listing.post('c', 'd')
+        self.assertEqual(self.poll(), ['d', 'c'])
+        self.assertEqual(self.listing.calls[-1], ('page', 't3_b'))
+        self.assertEqual(self.poller.cursor.id, 'd')
+
+    def test_full_page_pages_back(self):
+        self.listing.post('a')
+        self.poll()
+        self.listing.post('b', 'c', 'd', 'e', 'f')
+        self.assertEqual(self.poll(), ['f', 'e', 'd', 'c', 'b'])
+        self.assertEqual(self.listing.calls[-2:],
+                         [('page', 't3_a'), ('to_cursor', 'a')])
+        self.assertEqual(self.poller.cursor.id, 'f')
+
+    def test_empty_passes_resync(self):
+        self.listing.post('a')
+        self.poll()
+        # the cursor was removed, so reddit has nothing 'before' it
+        self.listing.removed.add('t3_a')
+        self.listing.post('b')
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(self.poll(), ['b'])
+        self.assertEqual(self.listing.calls[-1], ('to_cursor', 'a'))
+        self.assertEqual(self.poller.cursor.id, 'b')
+
+    def test_uncommitted_items_come_back(self):
+        self.listing.post('a')
+        self.poll()
+        self.listing.post('b', 'c')
+        items = self.poller.poll(None)
+        self.assertEqual([item.id for item in items], ['c', 'b'])
+        # not committed, so the cursor hasn't moved past them
+        self.assertEqual([item.id for item in self.poller.poll(None)],
+                         ['c', 'b'])
+        self.assertEqual(self.poller.cursor.id, 'a')
+
+    def test_failed_backs_off(self):
+        self.assertEqual(self.poller.failed(), 30)
+        self.assertEqual(self.poller.failed(), 60)
+        for i in range(5):
+            self.poller.failed()
+        self.assertEqual(self.poller.failed(), 600)
+        self.poller.schedule(0, 0)
+        self.assertEqual(self.poller.failed(), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,27 +1,230 @@
+import threading
+
+# parsed config files, each read once
+#      key: filename
+#      value: { section name: Config }
+_configs = {}
+_configs_lock = threading.Lock()
+
+# every (setting name, converter) read typed from any Config, merged ones
+#   included; a reload checks these settings still convert
+_typed_keys = set()
+
+class Config(object):
+    """ the { 'param': 'value' } settings of one config section.  values are
+        strings; get_int, get_float, get_bool and get_list convert them once
+        and remember the result.
+        the settings and their converted values are one snapshot that is
+        never changed: a change builds a new snapshot and swaps it in with a
+        single assignment, so a reader sees all of the old settings or all
+        of the new ones, and a converted value can't outlive its setting """
+
+    def __init__(self, *args, **kwargs):
+        # (settings, converted values); swapped whole, never changed
+        self._snapshot = (dict(*args, **kwargs), {})
+        # serialises changes, so two of them can't lose each other's update
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return self._snapshot[0][key]
+
+    def __contains__(self, key):
+        return key in self._snapshot[0]
+
+    def __iter__(self):
+        return iter(self._snapshot[0])
+
+    def __len__(self):
+        return len(self._snapshot[0])
+
+    def __repr__(self):
+        return 'Config({s!r})'.format(s=self._snapshot[0])
+
+    def get(self, key, default=None):
+        return self._snapshot[0].get(key, default)
+
+    def keys(self):
+        return self._snapshot[0].keys()
+
+    def items(self):
+        return self._snapshot[0].items()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            settings = dict(self._snapshot[0])
+            settings[key] = value
+            self._snapshot = (settings, {})
+
+    def update(self, *args, **kwargs):
+        with self._lock:
+            settings = dict(self._snapshot[0])
+            settings.update(*args, **kwargs)
+            self._snapshot = (settings, {})
+
+    def replace(self, settings):
+        """ given a dictionary of settings, swap them in for the current ones
+            (so every module sharing this Config sees the new values);
+            returns true if anything changed.  raises ValueError, keeping
+            the current settings, if a setting already read as an int, float,
+            etc doesn't convert (see check) """
+        snapshot = self.check(settings)
+        if snapshot is None:
+            return False
+        self._swap(snapshot)
+        return True
+
+    def check(self, settings):
+        """ given a dictionary of settings, convert every setting that's been
+            read typed (from any Config) again from them; returns the new
+            snapshot to swap in, or None if the settings are unchanged.
+            raises ValueError if one doesn't convert """
+
+        if self._snapshot[0] == settings:
+            return None
+        converted = {}
+        for key, convert in list(_typed_keys):
+            if key not in settings:
+                continue
+            try:
+                converted[(key, convert)] = convert(settings[key])
+            except (ValueError, TypeError, AttributeError):
+                raise ValueError('bad value for {k}: {v!r}'.format(
+                                                        k=key, v=settings[key]))
+        return (dict(settings), converted)
+
+    def _swap(self, snapshot):
+        """ swap in a snapshot from check """
+        with self._lock:
+            self._snapshot = snapshot
+
+    def get_int(self, key, default=None):
+        """ return the setting as an int (or default if it isn't set) """
+        return self._get_typed(key, int, default)
+
+    def get_float(self, key, default=None):
+        """ return the setting as a float (or default if it isn't set) """
+        return self._get_typed(key, float, default)
+
+    def get_bool(self, key, default=False):
+        """ return true if the setting is 1 (or true/yes) """
+        return self._get_typed(key, _to_bool, default)
+
+    def get_list(self, key, default=()):
+        """ return the comma separated setting as a tuple of its values """
+        return self._get_typed(key, _to_list, default)
+
+    def merged(self, other):
+        """ return a new Config of these settings overridden by other's """
+        config = Config(self._snapshot[0])
+        config.update(other)
+        return config
+
+    def _get_typed(self, key, convert, default):
+        """ return the setting converted with convert, converting it only the
+            first time it's asked for """
+        settings, typed = self._snapshot
+        cache_key = (key, convert)
+        try:
+            return typed[cache_key]
+        except KeyError:
+            pass
+        if key not in settings:
+            return default
+        value = convert(settings[key])
+        typed[cache_key] = value
+        _typed_keys.add(cache_key)
+        return value
+
+def _to_bool(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+def _to_list(value):
+    return tuple(v for v in value.split(',') if v)
+
 def get_config_params(section_name, filename='d3profilebot.config'):
     """ get the config parameters and values from the given section (logging,
-        bot, etc); return a dictionary of { 'param': 'value' } """
+        bot, etc); return a Config (dictionary) of { 'param': 'value' }.
+        the file is only read the first time, and every caller asking for the
+        same section shares the one Config """
 
-    with open(filename) as f:
-        config = {}
-        in_section = False
+    with _configs_lock:
+        sections = _configs.get(filename)
+        if sections is None:
+            sections = _configs[filename] = dict(
+                        (name, Config(settings))
+                        for name, settings in _read_config(filename).iteritems())
+        return sections.setdefault(section_name, Config())
 
+def reload_config(filename='d3profilebot.config'):
+    """ read the config file again and swap the new settings into every
+        section already handed out (see Config.replace); returns the set of
+        the names of the sections that changed.  every section is checked
+        before any is swapped, so if a setting doesn't convert this raises
+        ValueError and the old settings are all kept """
+
+    sections = _read_config(filename)
+    with _configs_lock:
+        current = _configs.setdefault(filename, {})
+        snapshots = {}
+        for name in set(current) | set(sections):
+            config = current.get(name)
+            if config is None:
+                config = Config()
+            snapshot = config.check(sections.get(name, {}))
+            if snapshot is not None:
+                snapshots[name] = (config, snapshot)
+
+        for name, (config, snapshot) in snapshots.iteritems():
+            config._swap(snapshot)
+            current.setdefault(name, config)
+    return set(snapshots)
+
+def _read_config(filename):
+    """ read every section of the config file; returns a dictionary of
+        { section name: { 'param': 'value' } }.  whitespace anywhere in a line
+        is dropped and a section ends at the first empty line """
+
+    sections = {}
+    with open(filename) as f:
+        config = None
         for line in f:
-            if in_section and not line == '\n':
+            if config is not None and not line == '\n':
                 setting = ''.join(line.split()).split(':')
-                value = setting[1]
-
-                if len(setting) > 2:
-                    # build a string for all settings[1+]
-                    for i in range(2, len(setting)):
-                        value = ''.join([value, ':', setting[i]])
-
-                config[setting[0]] = value
-            elif in_section and line == '\n':
-                break
-            elif '[{section}]'.format(section=section_name) in line:
-                in_section = True
-    return config
+                # values may contain ':' (urls, etc)
+                config[setting[0]] = ':'.join(setting[1:])
+            elif config is not None and line == '\n':
+                config = None
+            elif line.startswith('[') and ']' in line:
+                name = line[1:line.index(']')]
+                if name in sections:
+                    # only the first section of a name counts
+                    config = {}
+                else:
+                    config = sections[name] = {}
+    return sections
+
+def read_hero_list(filename):
+    """ read a file of heroes, one per line as region,profile[,hero] where hero
+        is a hero id or name (blank for the profile's main hero); blank lines
+        and lines starting with # are skipped.  returns a list of dictionaries
+        of { 'line', 'region', 'profile', 'hero_id', 'hero' } """
+
+    heroes = []
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            line = line.decode('utf-8').strip()
+            if not line or line.startswith('#'):
+                continue
+
+            fields = [field.strip() for field in line.split(',')]
+            hero = fields[2] if len(fields) > 2 else ''
+            is_id = hero.isdigit()
+            heroes.append({ 'line': number,
+                            'region': fields[0].lower(),
+                            'profile': fields[1] if len(fields) > 1 else '',
+                            'hero_id': hero if is_id else None,
+                            'hero': hero if hero and not is_id else None })
+    return heroes
 
 
 